@@ -0,0 +1,269 @@
+##########################################################################
+# Vectorized DSP kernels shared by the PySynth engines
+##########################################################################
+
+import numpy as np
+
+from .notecache import NoteCache
+
+__all__ = (
+    "grow",
+    "onepole",
+    "fade_tail",
+    "fade_ramp",
+    "saw_table",
+    "wavetable",
+    "pulse",
+    "decay_env",
+    "NoiseBank",
+    "resample",
+    "Scratch",
+    "phase",
+)
+
+# Largest growth (in nepers) of the inverse pole powers within one block.
+# Keeping a^-n below e^40 stays far from overflow, also in float32.
+block_nepers = 40.0
+
+# Signals cached by the kernels below, least recently used out once they
+# take more than the budget:
+#   ("saw", piano key, sample rate, dtype)  single-cycle oscillator tables
+#   ("pulse", period, duty, dtype)          pulse waves, grown on demand
+#   ("decay", time constant, dtype)         decay envelopes, grown on demand
+signals = NoteCache(32 << 20)
+
+
+def grow(cache, key, length: int, make):
+    """Read-only prefix of ``length`` samples of a cached signal.
+
+    ``make(n)`` renders the first ``n`` samples; the cached copy is only
+    re-rendered (at least doubling) when a longer prefix is asked for.
+    ``cache`` is a dict or a NoteCache such as ``signals``.
+    """
+    sig = cache.get(key)
+    if sig is None or len(sig) < length:
+        sig = make(max(length, 2 * len(sig) if sig is not None else 0))
+        sig.flags.writeable = False
+        cache[key] = sig
+
+    return sig[:length]
+
+
+def onepole(x: np.ndarray, k: float, zi: float = 0.0):
+    """One-pole low-pass ``y[n] = y[n-1] + (x[n] - y[n-1]) / k`` over a buffer.
+
+    ``zi`` is the filter state before the first sample. The state after the
+    last sample is returned along with the output, so consecutive buffers
+    (e.g. successive notes) can be filtered as one continuous signal.
+    """
+    if k < 1:
+        raise ValueError("smoothing factor k must be at least 1")
+
+    x = np.asarray(x)
+    y = np.empty(x.shape, np.result_type(x.dtype, np.float32))
+    a = 1.0 - 1.0 / k
+    if a == 0.0:
+        y[:] = x
+        return y, (y[-1] if len(y) else zi)
+
+    # Within a block the recursion has the closed form
+    #   y[n] = a^n * (a * y[-1] + sum_{m<=n} a^-m * x[m] / k),
+    # so each block is a single cumsum seeded with the previous block's end.
+    block = max(1, int(block_nepers / -np.log(a)))
+    pn = (a ** np.arange(min(block, len(x)))).astype(y.dtype)
+    inv = 1.0 / pn
+
+    state = zi
+    for start in range(0, len(x), block):
+        xs = x[start : start + block]
+        n = len(xs)
+        y[start : start + n] = pn[:n] * (a * state + np.cumsum(xs * inv[:n]) / k)
+        state = y[start + n - 1]
+
+    return y, state
+
+
+def fade_tail(
+    length: int, ramp: np.ndarray | None = None, tail: int = 100, dtype=float
+):
+    """Envelope of ``length`` ones that fades out over the last samples.
+
+    ``ramp[j]`` is the gain ``j`` samples before the end of the note; it
+    defaults to the linear fade ``(j + 1) / tail``. Only the last
+    ``tail - 1`` samples are affected, as in the original per-sample loops.
+    """
+    if ramp is None:
+        ramp = np.arange(1, tail) / tail
+
+    n = min(length, tail - 1, len(ramp))
+    fade = np.ones(length, dtype)
+    fade[length - n :] = ramp[:n][::-1]
+    return fade
+
+
+def fade_ramp(length: int, tail: int = 100):
+    """Ramp for fade_tail() that falls linearly from 1 to 0 over the note.
+
+    The same values as ``np.linspace(1, 0, length)``, but only the first
+    ``tail - 1`` of them, the ones fade_tail() uses.
+    """
+    ramp = np.arange(min(length, tail - 1), dtype=float)
+    if length > 1:
+        ramp *= -1.0 / (length - 1)
+    ramp += 1.0
+    if 1 < length == len(ramp):
+        ramp[-1] = 0.0
+    return ramp
+
+
+def saw_table(key: float, rate: int, dtype=float):
+    """Band-limited single cycle of a rising sawtooth from -1 to 1.
+
+    ``key`` is the (possibly transposed) piano key number, 0 = a0. Only
+    the harmonics below Nyquist at that pitch are summed, so the table
+    can be played back at its own pitch without aliasing. Tables are built
+    once per (key, rate), as long as they stay in ``signals``, and carry
+    one guard sample for interpolation.
+    """
+    dtype = np.dtype(dtype)
+    table = signals.get(("saw", key, rate, dtype))
+    if table is None:
+        hz = 27.5 * np.exp2(key / 12.0)
+        harm = max(1, int(rate / 2.0 / hz))
+        size = max(2048, 1 << (2 * harm + 1).bit_length())
+
+        # 2 x - 1 = -2 / pi * sum(sin(2 pi n x) / n)
+        n = np.arange(1, harm + 1)
+        spec = np.zeros(size // 2 + 1, complex)
+        spec[n] = 1j * size / (np.pi * n)
+        table = np.fft.irfft(spec, size)
+        table = np.append(table, table[0]).astype(dtype)
+        signals.put(("saw", key, rate, dtype), table)
+
+    return table
+
+
+def wavetable(table: np.ndarray, step: float, length: int, phase: float = 0.0):
+    """Play a guarded single-cycle table for ``length`` samples.
+
+    ``step`` is the phase increment in cycles per sample (frequency / rate);
+    fractional table positions are linearly interpolated. Positions are
+    tracked in double precision; the result has the dtype of the table.
+    """
+    size = len(table) - 1
+    pos = (phase + step * np.arange(length)) % 1.0 * size
+    idx = pos.astype(int)
+    frac = (pos - idx).astype(table.dtype, copy=False)
+    return table[idx] + frac * (table[idx + 1] - table[idx])
+
+
+def pulse(period: float, length: int, duty: float = 0.5, dtype=float):
+    """Pulse wave of ``period`` samples, ``length`` samples long.
+
+    Each period starts low (-1) and is high (+1) for its last ``duty``
+    fraction, so ``duty=0.5`` is a plain square wave. The wave always
+    starts at phase 0, so every note of a pitch is a prefix of the same
+    signal: it is cached per (period, duty) and returned as a read-only
+    view, growing the cached copy only when a longer note comes along.
+    Cached waves count against the budget of ``signals``.
+    """
+    if not 0.0 < duty < 1.0:
+        raise ValueError("duty cycle must be between 0 and 1")
+
+    return grow(
+        signals,
+        ("pulse", period, duty, np.dtype(dtype)),
+        length,
+        lambda n: np.where(
+            np.arange(n) % period >= (1.0 - duty) * period, 1.0, -1.0
+        ).astype(dtype, copy=False),
+    )
+
+
+def decay_env(length: int, tau: float, dtype=float):
+    """Exponential decay ``exp(-x / tau)``, cached per ``tau`` like pulse()."""
+    return grow(
+        signals,
+        ("decay", tau, np.dtype(dtype)),
+        length,
+        lambda n: np.exp(-np.arange(n) / tau).astype(dtype, copy=False),
+    )
+
+
+class NoiseBank:
+    """Seedable source of uniform white noise in [0, 1).
+
+    Noise is drawn from a ``numpy.random.Generator`` in large blocks and
+    handed out in consecutive slices, so a percussion hit costs a slice
+    instead of one draw per sample. The same seed gives the same noise,
+    drawn in double precision and then converted to ``dtype``.
+    """
+
+    def __init__(self, seed: int | None = None, size: int = 1 << 16, dtype=float):
+        self.rng = np.random.default_rng(seed)
+        self.size = size
+        self.dtype = dtype
+        self.block = self.rng.random(size).astype(dtype)
+        self.pos = 0
+
+    def take(self, length: int):
+        if self.pos + length > len(self.block):
+            rest = self.block[self.pos :]
+            more = self.rng.random(max(self.size, length - len(rest)))
+            self.block = np.concatenate([rest, more.astype(self.dtype)])
+            self.pos = 0
+
+        noise = self.block[self.pos : self.pos + length]
+        self.pos += length
+        return noise
+
+
+def resample(x: np.ndarray, fac: float):
+    """Pitch-shift ``x`` by playing it back ``fac`` times faster.
+
+    Linear interpolation between neighbouring samples; ``fac > 1`` raises
+    the pitch and shortens the sound, ``fac < 1`` lowers and stretches it.
+    """
+    if fac == 1.0:
+        return x
+
+    pos = np.arange(int(len(x) / fac)) * fac
+    idx = pos.astype(int)
+    q = pos - idx
+    return (1 - q) * x[idx] + q * x[np.minimum(idx + 1, len(x) - 1)]
+
+
+class Scratch:
+    """Work buffers reused from note to note instead of allocated per note.
+
+    ``take(length, slot)`` returns the first ``length`` samples of buffer
+    ``slot``, growing it (at least doubling) when a longer one is needed.
+    The contents are left over from earlier use.
+    """
+
+    def __init__(self, dtype=float):
+        self.dtype = dtype
+        self.bufs: dict[int, np.ndarray] = {}
+
+    def take(self, length: int, slot: int = 0):
+        buf = self.bufs.get(slot)
+        if buf is None or len(buf) < length:
+            size = max(length, 2 * len(buf) if buf is not None else 0)
+            buf = self.bufs[slot] = np.empty(size, self.dtype)
+
+        return buf[:length]
+
+
+def phase(x: np.ndarray, period, mult: float = 1.0, dtype=float):
+    """Phase ``mult * 2 pi * x / period`` in radians, for sine oscillators.
+
+    In double precision this is the plain expression. Narrower dtypes
+    would lose the phase of long notes, so there it is computed in double
+    precision and wrapped to one cycle before the conversion.
+    """
+    if np.dtype(dtype) == np.float64:
+        return mult * 2.0 * np.pi * x / period
+
+    cycles = mult * np.asarray(x, float) / period
+    cycles -= np.floor(cycles)
+    return (2.0 * np.pi * cycles).astype(dtype)
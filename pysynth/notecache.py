@@ -0,0 +1,81 @@
+##########################################################################
+# Process-wide cache of synthesized notes, shared between make_wav calls
+##########################################################################
+
+from collections import OrderedDict
+
+import numpy as np
+
+__all__ = ("NoteCache", "enable", "disable")
+
+
+class NoteCache:
+    """Synthesized note waveforms within a byte budget, least recently used out.
+
+    Keys identify everything a waveform depends on, e.g.
+    ``(engine, note, rate, transpose, params...)``. Stored arrays are made
+    read-only, so they can be handed out and mixed without copying.
+    """
+
+    def __init__(self, budget: int = 256 << 20):
+        self.budget = budget
+        self.entries: OrderedDict = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        wave = self.entries.get(key)
+        if wave is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        return wave
+
+    def put(self, key, wave: np.ndarray):
+        wave.flags.writeable = False
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+
+        self.entries[key] = wave
+        self.nbytes += wave.nbytes
+        while self.nbytes > self.budget and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+        return wave
+
+    def __setitem__(self, key, wave: np.ndarray):
+        self.put(key, wave)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = self.hits = self.misses = 0
+
+
+# The cache used by the engines; None (the default) keeps caching per call
+shared: NoteCache | None = None
+
+
+def enable(budget: int = 256 << 20):
+    """Share synthesized notes between all make_wav calls of this process."""
+    global shared
+    if shared is None:
+        shared = NoteCache(budget)
+    shared.budget = budget
+    return shared
+
+
+def disable():
+    global shared
+    shared = None
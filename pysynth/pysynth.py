@@ -31,9 +31,12 @@
 from io import BytesIO
 from typing import Iterable
 
+from .dsp import phase
 from .mkfreq import getfreq
+from .score import rest, timeline
+from .stream import replay, write_wav
 
-__all__ = ("make_wav",)
+__all__ = ("make_wav", "render", "render_blocks")
 
 pitchhz, keynum = getfreq()
 
@@ -66,12 +69,10 @@ pitchhz, keynum = getfreq()
 harm_max = 4.0
 ##########################################################################
 
-import wave
-
 import numpy as np
 
 
-def make_wav(
+def render_blocks(
     song: Iterable[tuple[str, float]],
     bpm: float = 120.0,
     rate: float = 44100,
@@ -80,103 +81,112 @@ def make_wav(
     pause: float = 0.05,
     boost: float = 1.0,
     repeat: int = 0,
-    fn: str | BytesIO = "out.wav",
-    closing: bool = True,
+    dtype=np.float64,
 ):
-    f = wave.open(fn, "w")
-
-    f.setnchannels(1)
-    f.setsampwidth(2)
-    f.setframerate(rate)
-    f.setcomptype("NONE", "Not Compressed")
-
-    bpmfac = 120.0 / bpm
-
-    def length(l: float):
-        return 2 * rate / l * bpmfac
-
-    def waves2(hz: float, l: float):
-        a = rate / hz
-        b = float(l) / rate * hz
-        return a, round(b)
-
-    def asin(x: float):
-        return np.sin(2.0 * np.pi * x)
-
-    def render2(a, b, vol):
-        b2 = (1.0 - pause) * b
-        l = waves2(a, b2)
-        q = int(l[0] * l[1])
-
+    """Render a song as a block of samples per note (and per rest).
+
+    The blocks add up to the output of make_wav(), which streams them to
+    the file as they come. Nothing is normalized.
+    Repeats replay the blocks of the first pass, which are all kept in
+    memory until then.
+    """
+    if repeat:
+        blocks = render_blocks(
+            song, bpm, rate, transpose, leg_stac, pause, boost, dtype=dtype
+        )
+        yield from replay(blocks, repeat)
+        return
+
+    dtype = np.dtype(dtype)
+
+    def asin(cycles: np.ndarray):
+        return np.sin(phase(cycles, 1.0, dtype=dtype))
+
+    def render2(a: float, period: float, q: int, vol: float):
         # harmonics are frequency-dependent:
-        lf = np.log(a)
+        lf = float(np.log(a))
         lf_fac = (lf - 3.0) / harm_max
         harm = 0 if lf_fac > 1 else 2.0 * (1 - lf_fac)
         decay = 2.0 / lf
         t = (lf - 3.0) / (8.5 - 3.0)
-        volfac = 1.0 + 0.8 * t * np.cos(np.pi / 5.3 * (lf - 3.0))
-
-        for x in range(q):
-            if x < 100:
-                fac = x / 80.0
-            elif 100 <= x < 300:
-                fac = 1.25 - (x - 100) / 800.0
-            elif x > q - 400:
-                fac = 1.0 - ((x - q + 400) / 400.0)
-            else:
-                fac = 1.0
-
-            s = float(x) / float(q)
-            dfac = 1.0 - s + s * decay
-
-            yield (
-                (
-                    asin(float(x) / l[0])
-                    + harm * asin(float(x) / (l[0] / 2.0))
-                    + 0.5 * harm * asin(float(x) / (l[0] / 4.0))
-                )
-                / 4.0
-                * fac
-                * vol
-                * dfac
-                * volfac
+        volfac = 1.0 + 0.8 * t * float(np.cos(np.pi / 5.3 * (lf - 3.0)))
+
+        # attack, decay and release of the envelope, all at once
+        n = np.arange(q, dtype=float)
+        x = n.astype(dtype, copy=False)
+        fac = np.select(
+            [x < 100, x < 300, x > q - 400],
+            [x / 80.0, 1.25 - (x - 100) / 800.0, 1.0 - ((x - q + 400) / 400.0)],
+            1.0,
+        )
+
+        s = x / float(q)
+        dfac = 1.0 - s + s * decay
+
+        return (
+            (
+                asin(n / period)
+                + harm * asin(n / (period / 2.0))
+                + 0.5 * harm * asin(n / (period / 4.0))
             )
+            / 4.0
+            * fac
+            * vol
+            * dfac
+            * volfac
+        )
 
     ##########################################################################
-    # Write to output file (in WAV format)
+    # Render the notes one after another
     ##########################################################################
 
-    for x, y in np.tile(song, (repeat + 1, 1)):  # type: ignore
-        y = float(y)
-
-        if x == "r":
-            b = length(y)
-            f.writeframesraw(b"\x00\x00" * int(b))  # Zero padding for rest
+    tl = timeline(song, bpm, rate, transpose, pause, boost)
+    for kn, a, vol, _, _, period, _, q, _ in tl.tolist():
+        if kn == rest:
+            yield np.zeros(q, dtype)  # silence for the rest
             continue
 
-        if x[-1] == "*":
-            vol, note = boost, x[:-1]
-        else:
-            vol, note = 1.0, x
+        wave_samples = render2(a, period, q, vol)
+        yield wave_samples
 
-        try:
-            a = pitchhz[note]
-        except:
-            a = pitchhz[note + "4"]  # default to fourth octave
 
-        a *= np.exp2(transpose)
-
-        if y < 0:
-            b = length(-2.0 * y / 3.0)
-        else:
-            b = length(y)
+def render(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: float = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    dtype=np.float64,
+):
+    """Render a song to an array of samples in [-1, 1], as make_wav() writes
+    them. Returns the samples and the sample rate.
+    """
+    blocks = render_blocks(
+        song, bpm, rate, transpose, leg_stac, pause, boost, repeat, dtype=dtype
+    )
+    return np.concatenate([np.zeros(0, dtype), *blocks]), rate
 
-        wave_samples = np.array(list(render2(a, b, vol)))
-        f.writeframesraw((wave_samples * 32767).astype(np.int16).tobytes())
 
-    f.writeframes(b"")
-    if closing:
-        f.close()
+def make_wav(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: float = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    fn: str | BytesIO = "out.wav",
+    closing: bool = True,
+    dtype=np.float64,
+):
+    blocks = render_blocks(
+        song, bpm, rate, transpose, leg_stac, pause, boost, repeat, dtype=dtype
+    )
+    write_wav(fn, blocks, rate, closing)
 
 
 ##########################################################################
@@ -1,10 +1,20 @@
-import wave
 from io import BytesIO
 from typing import Iterable
 
 import numpy as np
 
+from . import notecache
+from .dsp import Scratch, decay_env, grow, phase
 from .mkfreq import getfreq
+from .score import compile_score, phrases, rest, song_end, timeline
+from .stream import (
+    OverlapAdd,
+    assemble,
+    gain_stage,
+    headroom,
+    repeat_passes,
+    write_wav,
+)
 
 # 'song' is a Python list (or tuple) in which the song is defined,
 #   the format is [['note', value]]
@@ -22,7 +32,7 @@ from .mkfreq import getfreq
 # 2.66 = -4 = dotted quarter
 # 5.33 = -8 = dotted eighth
 
-__all__ = ("make_wav",)
+__all__ = ("make_wav", "render", "render_blocks")
 
 
 pitchhz, keynum = getfreq()
@@ -48,10 +58,11 @@ for h in range(1, len(harmo[0])):
     ux = np.max(xvals)
     lx = np.min(xvals)
     for h2 in range(88):
-        ux_vals = np.where(dat[:, 0] > h2 + 1, dat[:, 0], ux)
-        uy = dat[np.argmin(ux_vals), 1]
-        lx_vals = np.where(dat[:, 0] < h2 + 1, dat[:, 0], lx)
-        ly = dat[np.argmax(lx_vals), 1]
+        # nearest data points above and below the key, the last and
+        # first ones beyond the ends of the table
+        upper = min(np.searchsorted(xvals, h2 + 1, side="right"), len(dat) - 1)
+        lower = max(np.searchsorted(xvals, h2 + 1, side="left") - 1, 0)
+        uy, ly = dat[upper, 1], dat[lower, 1]
         harmtab[h2, h] = (float(h2 + 1) - lx) / (ux - lx) * (uy - ly) + ly
 
 for h2 in range(88):
@@ -80,6 +91,13 @@ for h2 in range(88):
 # Output file name
 # fn = 'pysynth_output.wav'
 
+# Gain staging: "peak" normalizes the finished song, "headroom" and
+# "limit" scale each block as it is rendered (see stream.gain_stage)
+# e.g. gain = "limit"
+
+# Largest amplitude of a single note, for the "headroom" estimate
+note_peak = 2.0
+
 # Other parameters:
 
 # Influences the decay of harmonics over frequency. Lowering the
@@ -88,6 +106,12 @@ for h2 in range(88):
 #  of speakers/headphones used
 harm_max = 5.0
 
+# Overtones quieter than this level (in dB, relative to the fundamental)
+# are not synthesized at all. Use -np.inf to always render all of them.
+# At -60 dB, the 16-bit output stays within 16 LSB of rendering all of
+# them (at most 15 on the demo songs).
+quality = -60.0
+
 att_len = 3000
 att_bass = np.array(
     [
@@ -118,8 +142,24 @@ decay = np.exp(
     )
 )
 
+# Overtones of each note: (multiple of the fundamental, column of harmtab)
+overtones = ((2.0, 2), (3.0, 3), (4.0, 4), (8.0, 5))
 
-def make_wav(
+
+def audible_partials(threshold: float):
+    """Overtones of each key that are at least ``threshold`` dB loud."""
+    floor = 10.0 ** (threshold / 20.0)
+    return [
+        [(mult, h) for mult, h in overtones if harmtab[k, h] >= floor]
+        for k in range(88)
+    ]
+
+
+# Overtones to synthesize for each key, by quality threshold
+partial_lists = {quality: audible_partials(quality)}
+
+
+def render_blocks(
     song: Iterable[tuple[str, float]],
     bpm: float = 120.0,
     rate: float = 44100.0,
@@ -128,127 +168,212 @@ def make_wav(
     pause: float = 0.05,
     boost: float = 1.0,
     repeat: int = 0,
-    fn: str | BytesIO = "out.wav",
-    closing: bool = True,
+    quality: float = quality,
+    block: int = 1 << 16,
+    gain: str | None = None,
+    phrase: int = 0,
+    dtype=np.float64,
 ):
-    data = []
+    """Render a song as consecutive blocks of raw (unnormalized) samples.
+
+    Notes are mixed in a ring buffer and every block is handed out as soon
+    as no later note can reach into it, so memory does not grow with the
+    length of the song (but see below for repeats). The blocks add up to
+    the full output of make_wav().
+    Synthesis, caches and the mix all run in ``dtype``.
+    With ``gain``, the blocks come scaled for output by that gain mode
+    instead (see stream.gain_stage). With ``phrase``, runs of that many
+    notes that come back later are rendered once (see score.phrases()).
+    Repeated passes and phrases are rendered whole and kept until they last
+    come back, so with ``repeat`` a whole pass of the song is held in memory.
+    """
+    if gain is not None:
+        level = 1.0
+        if gain != "peak":
+            level = headroom(song, bpm, rate, repeat, boost * note_peak)
+        blocks = render_blocks(
+            song,
+            bpm,
+            rate,
+            transpose,
+            leg_stac,
+            pause,
+            boost,
+            repeat,
+            quality,
+            block=block,
+            phrase=phrase,
+            dtype=dtype,
+        )
+        yield from gain_stage(blocks, gain, level)
+        return
+
+    dtype = np.dtype(dtype)
     note_cache = {}
     cache_this = {}
+    shared = notecache.shared
+    attacks = {}
+    vibratos = {}
+    work = Scratch(dtype)
 
-    f = wave.open(fn, "w")
-
-    f.setnchannels(1)
-    f.setsampwidth(2)
-    f.setframerate(rate)
-    f.setcomptype("NONE", "Not Compressed")
-
-    bpmfac = 120.0 / bpm
+    if quality not in partial_lists:
+        partial_lists[quality] = audible_partials(quality)
+    active = partial_lists[quality]
 
-    def length(l):
-        return 2 * rate / l * bpmfac
-
-    def waves2(hz, l):
-        a = rate / hz
-        b = float(l) / rate * hz
-        return a, round(b)
-
-    def render2(a, b, vol, pos, knum, note):
-        l = waves2(a, b)
-        q = int(l[0] * l[1])
-
-        lf = np.log(a)
+    def render2(a, period, q, vol, pos, knum):
+        lf = float(np.log(a))
 
         t = (lf - 3.0) / (8.5 - 3.0)
-        volfac = 1.0 + 0.8 * t * np.cos(np.pi / 5.3 * (lf - 3.0))
-        schweb = waves2(lf * 100.0, b)[0]
+        volfac = 1.0 + 0.8 * t * float(np.cos(np.pi / 5.3 * (lf - 3.0)))
+        schweb = rate / (lf * 100.0)
         schweb_amp = 0.05 - (lf - 5.0) / 100.0
-        att_fac = np.minimum(knum / 87.0 * vol, 1.0)
-        snd_len = int(max(3.1 * q, rate))
-        fac = np.ones(snd_len)
-        fac[:att_len] = att_fac * att_treb + (1.0 - att_fac) * att_bass
-
-        raw_note = 12 * rate
-        if note not in note_cache:
-            x2 = np.arange(raw_note)
-            sina = 2.0 * np.pi * x2 / float(l[0])
-            ov = np.exp(-x2 / 3.0 / decay[int(lf * 100)] / rate)
-            new = (
-                np.sin(sina)
-                + ov * harmtab[kn, 2] * np.sin(2.0 * sina)
-                + ov * harmtab[kn, 3] * np.sin(3.0 * sina)
-                + ov * harmtab[kn, 4] * np.sin(4.0 * sina)
-                + ov * harmtab[kn, 5] * np.sin(8.0 * sina)
-            ) * volfac
-            new *= np.exp(-x2 / decay[int(lf * 100)] / rate)
-            if cache_this[note] > 1:
-                note_cache[note] = new.copy()
-        else:
-            new = note_cache[note].copy()
-        dec_ind = int(leg_stac * q)
-        new[dec_ind:] *= np.exp(-np.arange(raw_note - dec_ind) / 3000.0)
-        if snd_len > raw_note:
-            snd_len = raw_note
-        data[pos : pos + snd_len] += (
-            new[:snd_len]
-            * fac
-            * vol
-            * (
-                1.0
-                + schweb_amp * np.sin(2.0 * np.pi * np.arange(snd_len) / schweb / 32.0)
-            )
+        att_fac = min(knum / 87.0 * vol, 1.0)
+        snd_len = min(int(max(3.1 * q, rate)), int(12 * rate))
+
+        def partials(start, stop):
+            x2 = np.arange(start, stop, dtype=dtype)
+            sina = phase(x2, float(period), dtype=dtype)
+            dk = float(decay[int(lf * 100)])
+            new = np.sin(sina)
+            if active[knum]:
+                ov = np.exp(-x2 / 3.0 / dk / rate)
+                for mult, h in active[knum]:
+                    new += ov * float(harmtab[knum, h]) * np.sin(mult * sina)
+            new *= volfac
+            new *= np.exp(-x2 / dk / rate)
+            return new
+
+        # Only synthesize the samples this note plays; cached notes keep
+        # the longest prefix rendered so far and are extended on demand.
+        key = ("b", knum, rate, transpose, quality, dtype)
+        new = note_cache.get(knum)
+        if new is None and shared is not None:
+            new = shared.get(key)
+        if new is None or len(new) < snd_len:
+            if new is None:
+                new = partials(0, snd_len)
+            else:
+                new = np.concatenate([new, partials(len(new), snd_len)])
+            if shared is not None:
+                shared.put(key, new)
+        if cache_this[knum] > 1:
+            note_cache[knum] = new
+        new.flags.writeable = False
+
+        # Shape and mix the note in a scratch buffer; the cached waveform,
+        # the envelopes and the vibrato are shared read-only arrays.
+        if att_fac not in attacks:
+            attack = att_fac * att_treb + (1.0 - att_fac) * att_bass
+            attacks[att_fac] = attack.astype(dtype, copy=False)
+        vib = grow(
+            vibratos,
+            knum,
+            snd_len,
+            lambda n: (
+                1.0 + schweb_amp * np.sin(2.0 * np.pi * np.arange(n) / schweb / 32.0)
+            ).astype(dtype, copy=False),
         )
+        new = new[:snd_len]
+        dec_ind = min(int(leg_stac * q), snd_len)
+        out = work.take(snd_len)
+        out[:dec_ind] = new[:dec_ind]
+        release = decay_env(snd_len - dec_ind, 3000.0, dtype)
+        np.multiply(new[dec_ind:], release, out=out[dec_ind:])
+        out[:att_len] *= attacks[att_fac][:snd_len]
+        out *= vol
+        out *= vib
+        mix.add(pos, out)
+
+    tl = timeline(song, bpm, rate, transpose, 0.0, boost, repeat)  # no pause
+    for kn in compile_score(song)["key"].tolist():
+        cache_this[kn] = cache_this.get(kn, 0) + 1
+    mix = OverlapAdd(int(12 * rate), block, dtype)
+
+    def play(notes, stop):
+        mix.rewind()
+        for kn, a, vol, pos, _, period, _, q, _ in notes.tolist():
+            if kn == rest:
+                continue
+
+            yield from mix.blocks(int(pos))
+            render2(a, period, q, vol, int(pos), kn)
+
+        yield from mix.finish(stop)
+
+    stop = int(2.0 * rate + song_end(tl) + 0.5)
+    if phrase:
+        bounds, ids = phrases(tl, phrase)
+        yield from assemble(play, tl, bounds, ids, stop, block, dtype)
+    else:
+        yield from repeat_passes(play, tl, repeat, stop, block, dtype)
+
+
+def render(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: float = 44100.0,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    quality: float = quality,
+    gain: str = "peak",
+    phrase: int = 0,
+    dtype=np.float64,
+):
+    """Render a song to an array of samples, scaled as make_wav() writes them.
+
+    Returns the samples and the sample rate, without encoding anything.
+    """
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        quality,
+        gain=gain,
+        phrase=phrase,
+        dtype=dtype,
+    )
+    return np.concatenate(list(blocks)), rate
+
 
-    ex_pos = 0.0
-    t_len = 0
-    for y, x in song:
-        if x < 0:
-            t_len += length(-2.0 * x / 3.0)
-        else:
-            t_len += length(x)
-        if y[-1] == "*":
-            y = y[:-1]
-        if not y[-1].isdigit():
-            y += "4"
-        cache_this[y] = cache_this.get(y, 0) + 1
-    data = np.zeros(int((repeat + 1) * t_len + 10 * rate))
-
-    for x, y in np.tile(song, (repeat + 1, 1)):  # type: ignore
-        y = float(y)
-
-        if x == "r":
-            ex_pos += length(y)
-            continue
-
-        if x[-1] == "*":
-            vol, note = boost, x[:-1]
-        else:
-            vol, note = 1.0, x
-
-        if not note[-1].isdigit():
-            note += "4"  # default to fourth octave
-
-        a = pitchhz[note] * np.exp2(transpose)
-        kn = keynum[note]
-
-        if y < 0:
-            b = length(-2.0 * y / 3.0)
-        else:
-            b = length(y)
-
-        render2(a, b, vol, int(ex_pos), kn, note)
-        ex_pos = ex_pos + b
-
-    ##########################################################################
-    # Write to output file (in WAV format)
-    ##########################################################################
-
-    data /= data.max() * 2.0
-    out_len = int(2.0 * rate + ex_pos + 0.5)
-    data2 = np.zeros(out_len, np.short)
-    data2[:] = 32767.0 * data[:out_len]
-    f.writeframes(data2.tobytes())
-    if closing:
-        f.close()
+def make_wav(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: float = 44100.0,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    fn: str | BytesIO = "out.wav",
+    closing: bool = True,
+    quality: float = quality,
+    gain: str = "peak",
+    phrase: int = 0,
+    dtype=np.float64,
+):
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        quality,
+        gain=gain,
+        phrase=phrase,
+        dtype=dtype,
+    )
+    write_wav(fn, blocks, rate, closing)
 
 
 ##########################################################################
@@ -1,12 +1,14 @@
 import logging
-import struct
-import wave
 from io import BytesIO
 from typing import Iterable
 
 import numpy as np
 
-__all__ = ("make_wav",)
+from .dsp import signals
+from .score import compile_score, events, keyfreq, rest
+from .stream import write_wav
+
+__all__ = ("make_wav", "render", "render_blocks")
 
 keys_s = ("a", "a#", "b", "c", "c#", "d", "d#", "e", "f", "f#", "g", "g#")
 PITCHHZ = {}
@@ -23,9 +25,17 @@ waveform = [
     (0.5, 0.6, 0.0, -0.5),
     (0.6, 1.0, -0.5, 1.0),
 ]
+# Same breakpoints as np.interp() arguments (segments are contiguous)
+waveform_pos = [start for start, _, _, _ in waveform] + [waveform[-1][1]]
+waveform_level = [level for _, _, level, _ in waveform] + [waveform[-1][3]]
 
 
-def make_wav(
+def sixteenbit(samples: np.ndarray):
+    """16-bit PCM frames of a block, rounded to the nearest step."""
+    return np.clip(np.rint(32767 * samples), -32768, 32767).astype(np.int16).tobytes()
+
+
+def render_blocks(
     song: Iterable[tuple[str, float]],
     bpm: float = 120.0,  # tempo
     transpose: float = 0.0,
@@ -34,16 +44,8 @@ def make_wav(
     pause: float = 0.05,
     boost: float = 1.0,
     repeat: int = 0,
-    fn: str | BytesIO = "out.wav",
-    closing: bool = True,
 ):
-    # def make_wav(song, tempo=120, transpose=0, fn="out.wav"):
-    f = wave.open(fn, "w")
-
-    f.setnchannels(1)
-    f.setsampwidth(2)
-    f.setframerate(rate)
-    f.setcomptype("NONE", "Not Compressed")
+    """Render a song as a block of samples per note (and per rest)."""
 
     # Define a waveform that looks something like this
     #  \        /
@@ -55,83 +57,80 @@ def make_wav(
     full_notes_per_second = float(bpm) / 60 / 4
     full_note_in_samples = rate / full_notes_per_second
 
-    def sixteenbit(sample):
-        return struct.pack("h", round(32767 * sample))
-
-    def beep_single_period(period, volume: float = 1.0):
-        period_waveform = []
-        asin = lambda x: np.sin(2.0 * np.pi * x)
-
-        for x in range(period):
+    def beep_single_period(period: int, volume: float = 1.0):
+        """One period of the waveform, cached in ``dsp.signals``."""
+        cycle = signals.get(("beep", period, volume))
+        if cycle is None:
             # Position inside current period, 0..1
-            pos = float(x) / period
+            pos = np.arange(period) / period
 
             # Synth 1, using sine waves
-            level1 = (asin(pos) + asin(pos * 2)) / 2
-            level2 = 0
+            level1 = (np.sin(2.0 * np.pi * pos) + np.sin(2.0 * np.pi * pos * 2)) / 2
 
             # Synth 2, discrete, using waveform definition
-            for start, finish, start_level, finish_level in waveform:
-                if pos >= start and pos <= finish:
-                    localpos = (pos - start) / (finish - start)
-                    level2 = (finish_level - start_level) * localpos + start_level
-                    break
+            level2 = np.interp(pos, waveform_pos, waveform_level)
 
-            # Put both samples together, apply fadein/fadeout
-            level = (level1 + level2) / 2
-            period_waveform.append(level * volume)
-            # period_waveform_packed.append(sixteenbit(level))
+            # Put both samples together
+            cycle = (level1 + level2) / 2 * volume
+            signals.put(("beep", period, volume), cycle)
 
-        return period_waveform, b"".join(map(sixteenbit, period_waveform))
+        return cycle
 
-    def beep(freq, duration, sink, volume):
-        ow = b""
+    def beep(freq: float, duration: int, volume: float):
+        if duration <= 0:
+            return np.zeros(0)
 
         period = int(rate / 4 / freq)
-        period_waveform, period_waveform_packed = beep_single_period(period, volume)
-
-        x = 0
-        while x < duration:
-            if x < 100 or duration - x < 100:
-                # At borders we do fade in and fade out
-                fade_multiplier = min(x, duration - x) / 100.0
-                ow += sixteenbit(period_waveform[x % period] * fade_multiplier)
-            else:
-                if x % period == 0:
-                    # Optimization:
-                    # We're aligned with waveform, can fill ow in batches!
-                    while x + period + 100 < duration:
-                        ow += period_waveform_packed
-                        x += period
-
-                # Go sample-by-sample
-                ow += sixteenbit(period_waveform[x % period])
-            x += 1
-
-        sink.writeframesraw(ow)
-
-    def silence(duration, sink):
-        sink.writeframesraw(sixteenbit(0) * int(duration))
-
-    for note_pitch, note_duration in np.tile(song, (repeat + 1, 1)):  # type: ignore
-        note_duration = float(note_duration)
+        samples = np.resize(beep_single_period(period, volume), duration)
+
+        # At borders we do fade in and fade out
+        x = np.r_[0 : min(100, duration), max(duration - 99, 100) : duration]
+        samples[x] *= np.minimum(x, duration - x) / 100.0
+
+        return samples
+
+    for key, note_duration, volume in events(compile_score(song), boost, repeat):
         duration = int(full_note_in_samples / note_duration)
 
-        if note_pitch == "r":
-            silence(duration, f)
+        if key == rest:
+            yield np.zeros(max(duration, 0))
         else:
-            if note_pitch[-1] == "*":
-                note_pitch = note_pitch[:-1]
-                volume = boost
-            else:
-                volume = 1.0
-
-            freq = PITCHHZ[note_pitch]
-            freq *= np.exp2(transpose)
-            beep(freq, duration, f, volume)
-
-    if closing:
-        f.close()
+            freq = keyfreq[key] * np.exp2(transpose)
+            yield beep(freq, duration, volume)
+
+
+def render(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    transpose: float = 0.0,
+    rate: int = 44100,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+):
+    """Render a song to an array of samples in [-1, 1], as make_wav() writes
+    them. Returns the samples and the sample rate.
+    """
+    blocks = render_blocks(song, bpm, transpose, rate, leg_stac, pause, boost, repeat)
+    return np.concatenate([np.zeros(0), *blocks]), rate
+
+
+def make_wav(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,  # tempo
+    transpose: float = 0.0,
+    rate: int = 44100,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    fn: str | BytesIO = "out.wav",
+    closing: bool = True,
+):
+    # def make_wav(song, tempo=120, transpose=0, fn="out.wav"):
+    blocks = render_blocks(song, bpm, transpose, rate, leg_stac, pause, boost, repeat)
+    write_wav(fn, blocks, rate, closing, encode=sixteenbit)
 
 
 if __name__ == "__main__":
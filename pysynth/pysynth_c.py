@@ -28,21 +28,23 @@
 # 5.33 = -8 = dotted eighth
 """
 
-import wave
 from io import BytesIO
 from typing import Iterable
 
 import numpy as np
 
 from .demosongs import song3
+from .dsp import fade_ramp, fade_tail, onepole, saw_table, wavetable
 from .mkfreq import getfreq
+from .score import rest, timeline
+from .stream import replay, write_wav
 
-__all__ = ("make_wav",)
+__all__ = ("make_wav", "render", "render_blocks")
 
 pitchhz, keynum = getfreq()
 
 
-def make_wav(
+def render_blocks(
     song: Iterable[tuple[str, float]],
     bpm: float = 120.0,
     rate: int = 44100,
@@ -51,76 +53,77 @@ def make_wav(
     pause: float = 0.05,
     boost: float = 1.0,
     repeat: int = 0,
-    fn: str | BytesIO = "out.wav",
-    closing: bool = True,
+    dtype=np.float64,
 ):
-    f = wave.open(fn, "w")
-
-    f.setnchannels(1)
-    f.setsampwidth(2)
-    f.setframerate(rate)
-    f.setcomptype("NONE", "Not Compressed")
-
-    bpmfac = 120.0 / bpm
-
-    def length(l: float):
-        return 2 * rate / l * bpmfac
-
-    def waves2(hz: float, l: float):
-        a = rate / hz
-        b = float(l) / rate * hz
-        return a, round(b)
-
-    def render2(a: float, b: float, vol: float):
-        b2 = (1.0 - pause) * b
-        l = waves2(a, b2)
-        q = int(l[0] * l[1])
-
-        oscstep = 2.0 / l[0]
-        fade_array = np.linspace(1, 0, num=q)
-        osc, sp, fade = -1, 0, 1
-
-        for x in range(q):
-            if q - x < 100:
-                fade = fade_array[q - x - 1]
-            sp += (osc - sp) / 100
-            yield fade * vol * sp
-            osc += oscstep
-            if osc > 1:
-                osc = -1
-
-    # Keep as list[tuple[str, float]]
-    for x, y in np.tile(song, repeat + 1):  # type: ignore
-        y = float(y)
-
-        if x == "r":
-            b = length(y)
-            f.writeframesraw(b"\x00\x00" * int(b))  # Zero padding for rest
+    """Render a song as a block of samples per note (and per rest).
+
+    The blocks add up to the output of make_wav(), which streams them to
+    the file as they come. Nothing is normalized.
+    Repeats replay the blocks of the first pass, which are all kept in
+    memory until then.
+    """
+    if repeat:
+        blocks = render_blocks(
+            song, bpm, rate, transpose, leg_stac, pause, boost, dtype=dtype
+        )
+        yield from replay(blocks, repeat)
+        return
+
+    def render2(period: float, q: int, vol: float, knum: float):
+        osc = wavetable(saw_table(knum, rate, dtype), 1.0 / period, q)
+
+        fade = fade_tail(q, fade_ramp(q), dtype=dtype)
+        sp, _ = onepole(osc, 100)
+        return fade * vol * sp
+
+    tl = timeline(song, bpm, rate, transpose, pause, boost)
+    for key, _, vol, _, _, period, _, q, _ in tl.tolist():
+        if key == rest:
+            yield np.zeros(q, dtype)  # silence for the rest
             continue
 
-        if x[-1] == "*":
-            vol, note = boost, x[:-1]
-        else:
-            vol, note = 1.0, x
-
-        try:
-            a = pitchhz[note]
-        except:
-            a = pitchhz[note + "4"]  # default to fourth octave
+        kn = key + 12.0 * transpose
+        wave_samples = render2(period, q, vol, kn)
+        yield wave_samples
 
-        a *= np.exp2(transpose)
 
-        if y < 0:
-            b = length(-2.0 * y / 3.0)
-        else:
-            b = length(y)
+def render(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    dtype=np.float64,
+):
+    """Render a song to an array of samples in [-1, 1], as make_wav() writes
+    them. Returns the samples and the sample rate.
+    """
+    blocks = render_blocks(
+        song, bpm, rate, transpose, leg_stac, pause, boost, repeat, dtype=dtype
+    )
+    return np.concatenate([np.zeros(0, dtype), *blocks]), rate
 
-        wave_samples = np.array(list(render2(a, b, vol)))
-        f.writeframesraw((wave_samples * 32767).astype(np.int16).tobytes())
 
-    f.writeframes(b"")
-    if closing:
-        f.close()
+def make_wav(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    fn: str | BytesIO = "out.wav",
+    closing: bool = True,
+    dtype=np.float64,
+):
+    blocks = render_blocks(
+        song, bpm, rate, transpose, leg_stac, pause, boost, repeat, dtype=dtype
+    )
+    write_wav(fn, blocks, rate, closing)
 
 
 if __name__ == "__main__":
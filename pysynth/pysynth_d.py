@@ -28,19 +28,94 @@
 # 5.33 = -8 = dotted eighth
 """
 
-import wave
 from io import BytesIO
 from typing import Iterable
 
 import numpy as np
 
+from .dsp import fade_ramp, fade_tail, onepole, pulse
 from .mkfreq import getfreq
+from .score import rest, timeline
+from .stream import replay, write_wav
 
-__all__ = ("make_wav",)
+__all__ = ("make_wav", "render", "render_blocks")
 
 pitchhz, keynum = getfreq()
 
 
+def render_blocks(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    duty: float = 0.5,
+    dtype=np.float64,
+):
+    """Render a song as a block of samples per note (and per rest).
+
+    The blocks add up to the output of make_wav(), which streams them to
+    the file as they come. Nothing is normalized.
+    Repeats replay the blocks of the first pass, which are all kept in
+    memory until then.
+    """
+    if repeat:
+        blocks = render_blocks(
+            song, bpm, rate, transpose, leg_stac, pause, boost, duty=duty, dtype=dtype
+        )
+        yield from replay(blocks, repeat)
+        return
+
+    def render2(period: float, q: int, vol: float):
+        osc = pulse(period, q, duty, dtype)
+
+        fade = fade_tail(q, fade_ramp(q), dtype=dtype)
+        sp, _ = onepole(osc, 100)
+        return 0.5 * fade * vol * sp
+
+    tl = timeline(song, bpm, rate, transpose, pause, boost)
+    for kn, _, vol, _, _, period, _, q, _ in tl.tolist():
+        if kn == rest:
+            yield np.zeros(q, dtype)  # silence for the rest
+            continue
+
+        wave_samples = render2(period, q, vol)
+        yield wave_samples
+
+
+def render(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    duty: float = 0.5,
+    dtype=np.float64,
+):
+    """Render a song to an array of samples in [-1, 1], as make_wav() writes
+    them. Returns the samples and the sample rate.
+    """
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        duty=duty,
+        dtype=dtype,
+    )
+    return np.concatenate([np.zeros(0, dtype), *blocks]), rate
+
+
 def make_wav(
     song: Iterable[tuple[str, float]],
     bpm: float = 120.0,
@@ -52,75 +127,22 @@ def make_wav(
     repeat: int = 0,
     fn: str | BytesIO = "out.wav",
     closing: bool = True,
+    duty: float = 0.5,
+    dtype=np.float64,
 ):
-    f = wave.open(fn, "w")
-
-    f.setnchannels(1)
-    f.setsampwidth(2)
-    f.setframerate(rate)
-    f.setcomptype("NONE", "Not Compressed")
-
-    bpmfac = 120.0 / bpm
-
-    def length(l: float):
-        return 2 * rate / l * bpmfac
-
-    def waves2(hz: float, l: float):
-        a = rate / hz
-        b = float(l) / rate * hz
-        return a, round(b)
-
-    def render2(a: float, b: float, vol: float):
-        b2 = (1.0 - pause) * b
-        l = waves2(a, b2)
-        q = int(l[0] * l[1])
-
-        fade_array = np.linspace(1, 0, num=q)
-        osc, sp, fade = -1, 0, 1
-        halfp = l[0] / 2.0
-
-        for x in range(q):
-            osc = 1 if (x // halfp) % 2 else -1
-            if q - x < 100:
-                fade = fade_array[q - x - 1]
-            sp += (osc - sp) / 100
-            yield 0.5 * fade * vol * sp
-
-    curpos, ex_pos = 0, 0.0
-    for x, y in np.tile(song, (repeat + 1, 1)):  # type: ignore
-        y = float(y)
-
-        if x == "r":
-            b = length(y)
-            ex_pos += b
-            f.writeframesraw(b"\x00\x00" * int(b))  # Zero padding for rest
-            curpos += int(b)
-            continue
-
-        if x[-1] == "*":
-            vol, note = boost, x[:-1]
-        else:
-            vol, note = 1.0, x
-
-        try:
-            a = pitchhz[note]
-        except:
-            a = pitchhz[note + "4"]  # default to fourth octave
-
-        a *= np.exp2(transpose)
-        if y < 0:
-            b = length(-2.0 * y / 3.0)
-        else:
-            b = length(y)
-
-        ex_pos = ex_pos + b
-        wave_samples = np.array(list(render2(a, b, vol)))
-        f.writeframesraw((wave_samples * 32767).astype(np.int16).tobytes())
-        curpos += len(wave_samples)
-
-    f.writeframes(b"")
-    if closing:
-        f.close()
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        duty=duty,
+        dtype=dtype,
+    )
+    write_wav(fn, blocks, rate, closing)
 
 
 if __name__ == "__main__":
@@ -30,15 +30,28 @@
 # 5.33 = -8 = dotted eighth
 """
 
-import wave
+from collections import Counter
 from io import BytesIO
 from typing import Iterable
 
 import numpy as np
 
+from . import notecache
+from .dsp import Scratch, decay_env, phase
 from .mkfreq import getfreq
+from .score import keyfreq, phrases, rest, song_end, timeline
+from .stream import (
+    OverlapAdd,
+    assemble,
+    gain_stage,
+    headroom,
+    passes,
+    repeat_passes,
+    variants,
+    write_wav,
+)
 
-__all__ = ("make_wav",)
+__all__ = ("make_wav", "render", "render_blocks")
 
 pitchhz, keynum = getfreq()
 
@@ -105,6 +118,13 @@ decay = np.exp(
 # Output file name
 # fn = 'pysynth_output.wav'
 
+# Gain staging: "peak" normalizes the finished song, "headroom" and
+# "limit" scale each block as it is rendered (see stream.gain_stage)
+# e.g. gain = "limit"
+
+# Largest amplitude of a single note, for the "headroom" estimate
+note_peak = 3.0
+
 # Other parameters:
 
 # Influences the decay of harmonics over frequency. Lowering the
@@ -115,6 +135,175 @@ harm_max = 5.0
 ##########################################################################
 
 
+def render_blocks(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    block: int = 1 << 16,
+    gain: str | None = None,
+    phrase: int = 0,
+    dtype=np.float64,
+):
+    """Render a song as consecutive blocks of raw (unnormalized) samples.
+
+    Notes are mixed in a ring buffer and every block is handed out as soon
+    as no later note can reach into it, so memory does not grow with the
+    length of the song (but see below for repeats). The blocks add up to
+    the full output of make_wav().
+    Synthesis, caches and the mix all run in ``dtype``.
+    With ``gain``, the blocks come scaled for output by that gain mode
+    instead (see stream.gain_stage). With ``phrase``, runs of that many
+    notes that come back later are rendered once (see score.phrases()).
+    Repeated passes and phrases are rendered whole and kept until they last
+    come back, so with ``repeat`` a whole pass of the song is held in memory.
+    """
+    if gain is not None:
+        level = 1.0
+        if gain != "peak":
+            level = headroom(song, bpm, rate, repeat, boost * note_peak)
+        blocks = render_blocks(
+            song,
+            bpm,
+            rate,
+            transpose,
+            leg_stac,
+            pause,
+            boost,
+            repeat,
+            block=block,
+            phrase=phrase,
+            dtype=dtype,
+        )
+        yield from gain_stage(blocks, gain, level)
+        return
+
+    dtype = np.dtype(dtype)
+    note_cache = {}
+    raw_note = 12 * rate
+    work = Scratch(dtype)
+
+    def synth(kn: int, q: int):
+        """FM-synthesize the note of key ``kn`` that plays ``q`` samples."""
+        a = keyfreq[kn] * np.exp2(transpose)
+        l0 = rate / a
+        env_len = max(int(3.1 * q), rate)
+        snd_len = min(env_len, raw_note)
+        dec = dtype.type(decay[int(np.log(a) * 100)])
+
+        x2 = np.arange(snd_len, dtype=dtype)
+        env = dtype.type(env_len)
+        sina = phase(x2, l0, dtype=dtype)
+        sina14 = phase(x2, l0, 14.0, dtype)
+        amp1 = np.maximum(1.0 - (x2 / env), 0)
+        amp2 = np.maximum(1.0 - (4 * x2 / env), 0)
+        amp_3to6 = np.maximum(1.0 - (0.25 * x2 / env), 0)
+        new = (
+            amp1 * np.sin(sina + 0.58 * amp2 * np.sin(sina14))
+            + amp_3to6 * np.sin(sina + 0.89 * amp_3to6 * np.sin(sina))
+            + amp_3to6 * np.sin(sina + 0.79 * amp_3to6 * np.sin(sina))
+        )
+        new *= np.exp(-x2 / dec / rate)
+        new.flags.writeable = False
+        return new
+
+    def fetch(kn: int, q: int):
+        """The note of key ``kn`` and size ``q``, synthesized on first use."""
+        new = note_cache.get((kn, q))
+        if new is None:
+            # notes already synthesized by earlier calls, if caching across calls
+            key = ("e", kn, q, rate, transpose, dtype)
+            shared = notecache.shared
+            new = shared.get(key) if shared is not None else None
+            if new is None:
+                new = synth(kn, q)
+                if shared is not None:
+                    shared.put(key, new)
+            note_cache[kn, q] = new
+        return new
+
+    def render2(q, vol, pos, knum):
+        new = fetch(knum, q)
+        # drop the note after its last use
+        uses[knum, q] -= 1
+        if not uses[knum, q]:
+            del note_cache[knum, q]
+        snd_len = len(new)
+        dec_ind = min(int(leg_stac * q), snd_len)
+        out = work.take(snd_len)
+        out[:dec_ind] = new[:dec_ind]
+        release = decay_env(snd_len - dec_ind, 3000.0, dtype)
+        np.multiply(new[dec_ind:], release, out=out[dec_ind:])
+        out *= vol
+        mix.add(pos, out)
+
+    tl = timeline(song, bpm, rate, transpose, 0.0, boost, repeat)  # no pause
+    bounds, ids = phrases(tl, phrase) if phrase else passes(tl, repeat)
+    ids = variants(tl, bounds, ids)
+    # the rows that are played (the first of every phrase), and how often
+    # each note comes up in them
+    played = np.zeros(len(tl), bool)
+    for k in np.unique(ids, return_index=True)[1].tolist():
+        played[bounds[k] : bounds[k + 1]] = True
+    played &= tl["key"] != rest
+    uses = Counter(zip(tl["key"][played].tolist(), tl["size"][played].tolist()))
+    mix = OverlapAdd(raw_note, block, dtype)
+
+    def play(notes, stop):
+        mix.rewind()
+        for kn, _, vol, pos, _, _, _, q, _ in notes.tolist():
+            if kn == rest:
+                continue
+
+            yield from mix.blocks(int(pos))
+            render2(q, vol, int(pos), kn)
+
+        yield from mix.finish(stop)
+
+    stop = int(2.0 * rate + song_end(tl) + 0.5)
+    if phrase:
+        yield from assemble(play, tl, bounds, ids, stop, block, dtype)
+    else:
+        yield from repeat_passes(play, tl, repeat, stop, block, dtype)
+
+
+def render(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    gain: str = "peak",
+    phrase: int = 0,
+    dtype=np.float64,
+):
+    """Render a song to an array of samples, scaled as make_wav() writes them.
+
+    Returns the samples and the sample rate, without encoding anything.
+    """
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        gain=gain,
+        phrase=phrase,
+        dtype=dtype,
+    )
+    return np.concatenate(list(blocks)), rate
+
+
 def make_wav(
     song: Iterable[tuple[str, float]],
     bpm: float = 120.0,
@@ -126,109 +315,24 @@ def make_wav(
     repeat: int = 0,
     fn: str | BytesIO = "out.wav",
     closing: bool = True,
+    gain: str = "peak",
+    phrase: int = 0,
+    dtype=np.float64,
 ):
-    data = []
-    note_cache = {}
-    cache_this = {}
-
-    f = wave.open(fn, "w")
-
-    f.setnchannels(1)
-    f.setsampwidth(2)
-    f.setframerate(rate)
-    f.setcomptype("NONE", "Not Compressed")
-
-    bpmfac = 120.0 / bpm
-
-    def length(l: float):
-        return 2 * rate / l * bpmfac
-
-    def waves2(hz: float, l: float):
-        a = rate / hz
-        b = float(l) / rate * hz
-        return a, round(b)
-
-    def render2(a, b, vol, pos, knum, note):
-        l = waves2(a, b)
-        q = int(l[0] * l[1])
-        lf = np.log(a)
-        snd_len = max(int(3.1 * q), rate)
-
-        raw_note = 12 * rate
-        if note not in list(note_cache.keys()):
-            x2 = np.arange(raw_note)
-            sina = 2.0 * np.pi * x2 / float(l[0])
-            sina14 = 14.0 * 2.0 * np.pi * x2 / float(l[0])
-            amp1 = 1.0 - (x2 / snd_len)
-            amp1[amp1 < 0] = 0
-            amp2 = 1.0 - (4 * x2 / snd_len)
-            amp2[amp2 < 0] = 0
-            amp_3to6 = 1.0 - (0.25 * x2 / snd_len)
-            amp_3to6[amp_3to6 < 0] = 0
-            new = (
-                amp1 * np.sin(sina + 0.58 * amp2 * np.sin(sina14))
-                + amp_3to6 * np.sin(sina + 0.89 * amp_3to6 * np.sin(sina))
-                + amp_3to6 * np.sin(sina + 0.79 * amp_3to6 * np.sin(sina))
-            )
-            new *= np.exp(-x2 / decay[int(lf * 100)] / rate)
-            if cache_this[note] > 1:
-                note_cache[note] = new.copy()
-        else:
-            new = note_cache[note].copy()
-        dec_ind = int(leg_stac * q)
-        new[dec_ind:] *= np.exp(-np.arange(raw_note - dec_ind) / 3000.0)
-        if snd_len > raw_note:
-            snd_len = raw_note
-        data[pos : pos + snd_len] += new[:snd_len] * vol
-
-    ex_pos = 0.0
-    t_len = 0
-    for y, x in song:
-        if x < 0:
-            t_len += length(-2.0 * x / 3.0)
-        else:
-            t_len += length(x)
-        if y[-1] == "*":
-            y = y[:-1]
-        if not y[-1].isdigit():
-            y += "4"
-        cache_this[y] = cache_this.get(y, 0) + 1
-    # print "Note frequencies in song:", cache_this
-    data = np.zeros(int((repeat + 1) * t_len + 10 * rate))
-    # print len(data)/44100., "s allocated"
-
-    for x, y in np.tile(song, (repeat + 1, 1)):  # type: ignore
-        y = float(y)
-        if x == "r":
-            ex_pos += length(y)
-            continue
-
-        if x[-1] == "*":
-            vol, note = boost, x[:-1]
-        else:
-            vol, note = 1.0, x
-
-        if not note[-1].isdigit():
-            note += "4"  # default to fourth octave
-
-        a = pitchhz[note] * np.exp2(transpose)
-        kn = keynum[note]
-
-        if y < 0:
-            b = length(-2.0 * y / 3.0)
-        else:
-            b = length(y)
-
-        render2(a, b, vol, int(ex_pos), kn, note)
-        ex_pos += b
-
-    data /= data.max() * 2.0
-    out_len = int(2.0 * rate + ex_pos + 0.5)
-    data2 = np.zeros(out_len, np.short)
-    data2[:] = 32767.0 * data[:out_len]
-    f.writeframes(data2.tobytes())
-    if closing:
-        f.close()
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        gain=gain,
+        phrase=phrase,
+        dtype=dtype,
+    )
+    write_wav(fn, blocks, rate, closing)
 
 
 ##########################################################################
@@ -30,15 +30,23 @@
 # 5.33 = -8 = dotted eighth
 """
 
-import wave
 from io import BytesIO
 from typing import Iterable
 
 import numpy as np
 
 from .mkfreq import getfreq
-
-__all__ = ("make_wav",)
+from .score import phrases, rest, song_end, timeline
+from .stream import (
+    OverlapAdd,
+    assemble,
+    gain_stage,
+    headroom,
+    repeat_passes,
+    write_wav,
+)
+
+__all__ = ("make_wav", "render", "render_blocks")
 
 pitchhz, keynum = getfreq()
 
@@ -63,8 +71,15 @@ pitchhz, keynum = getfreq()
 # Output file name
 # fn = 'pysynth_output.wav'
 
+# Gain staging: "peak" normalizes the finished song, "headroom" and
+# "limit" scale each block as it is rendered (see stream.gain_stage)
+# e.g. gain = "limit"
 
-def make_wav(
+# Largest amplitude of a single note, for the "headroom" estimate
+note_peak = 1.0
+
+
+def render_blocks(
     song: Iterable[tuple[str, float]],
     bpm: float = 120.0,
     rate: int = 44100,
@@ -73,109 +88,168 @@ def make_wav(
     pause: float = 0.05,
     boost: float = 1.0,
     repeat: int = 0,
-    fn: str | BytesIO = "out.wav",
-    closing: bool = True,
+    block: int = 1 << 16,
+    gain: str | None = None,
+    phrase: int = 0,
+    dtype=np.float64,
 ):
-    data = []
-
-    f = wave.open(fn, "w")
-
-    f.setnchannels(1)
-    f.setsampwidth(2)
-    f.setframerate(rate)
-    f.setcomptype("NONE", "Not Compressed")
-
-    bpmfac = 120.0 / bpm
-
-    def length(l: float):
-        return 2 * rate / l * bpmfac
-
-    def waves2(hz: float, l: float):
-        a = rate / hz
-        b = float(l) / rate * hz
-        return a, round(b)
-
-    def render2(a, b, vol, pos, knum, note, endamp=0.25, sm=10):
-        b2 = (1.0 - pause) * b
-        l = waves2(a, b2)
-        q = int(l[0] * l[1])
-
-        lf = np.log(a)
+    """Render a song as consecutive blocks of raw (unnormalized) samples.
+
+    Notes are mixed in a ring buffer and every block is handed out as soon
+    as no later note can reach into it, so memory does not grow with the
+    length of the song (but see below for repeats). The blocks add up to
+    the full output of make_wav().
+    Synthesis and the mix run in ``dtype``.
+    With ``gain``, the blocks come scaled for output by that gain mode
+    instead (see stream.gain_stage). With ``phrase``, runs of that many
+    notes that come back later are rendered once (see score.phrases()).
+    Repeated passes and phrases are rendered whole and kept until they last
+    come back, so with ``repeat`` a whole pass of the song is held in memory.
+    """
+    if gain is not None:
+        level = 1.0
+        if gain != "peak":
+            level = headroom(song, bpm, rate, repeat, boost * note_peak)
+        blocks = render_blocks(
+            song,
+            bpm,
+            rate,
+            transpose,
+            leg_stac,
+            pause,
+            boost,
+            repeat,
+            block=block,
+            phrase=phrase,
+            dtype=dtype,
+        )
+        yield from gain_stage(blocks, gain, level)
+        return
+
+    def render2(a, period, cycles, q, vol, pos, endamp=0.25, sm=10):
+        lf = float(np.log(a))
         t = (lf - 3.0) / (8.5 - 3.0)
-        volfac = 1.0 + 0.8 * t * np.cos(np.pi / 5.3 * (lf - 3.0))
+        volfac = 1.0 + 0.8 * t * float(np.cos(np.pi / 5.3 * (lf - 3.0)))
         snd_len = int((10.0 - lf) * q)
         if lf < 4:
             snd_len *= 2
 
-        kp_len = int(l[0])
-        kps1 = np.zeros(snd_len)
-        kps2 = np.zeros(snd_len)
+        kp_len = int(period)
+        kps1 = np.zeros(snd_len, dtype)
+        kps2 = np.zeros(snd_len, dtype)
         kps1[:kp_len] = np.random.normal(size=kp_len)
 
-        for t in range(kp_len):
-            kps2[t] = kps1[t : t + sm].mean()
+        # smooth the noise burst with a (forward) moving average of sm samples
+        csum = np.append(0.0, np.cumsum(kps1))
+        t = np.arange(kp_len)
+        end = np.minimum(t + sm, snd_len)
+        kps2[:kp_len] = (csum[end] - csum[t]) / (end - t)
 
-        delt = float(l[0])
+        delt = float(period)
         li = int(np.floor(delt))
         hi = int(np.ceil(delt))
         ifac = delt % 1
         delt2 = delt * (np.floor(delt) - 1) / np.floor(delt)
         ifac2 = delt2 % 1
-        falloff = (4.0 / lf * endamp) ** (1.0 / l[1])
-        for t in range(hi, snd_len):
-            v1 = ifac * kps2[t - hi] + (1.0 - ifac) * kps2[t - li]
-            v2 = ifac2 * kps2[t - hi + 1] + (1.0 - ifac2) * kps2[t - li + 1]
-            kps2[t] += 0.5 * (v1 + v2) * falloff
-        data[pos : pos + snd_len] += kps2 * vol * volfac
-
-    ex_pos = 0.0
-    t_len = 0
-    for y, x in song:
-        if x < 0:
-            t_len += length(-2.0 * x / 3.0)
-        else:
-            t_len += length(x)
-    data = np.zeros(int((repeat + 1) * t_len + 20 * rate))
-
-    # print len(data)/rate., "s allocated"
-
-    for x, y in np.tile(song, (repeat + 1, 1)):  # type: ignore
-        y = float(y)
-        if x == "r":
-            b = length(y)
-            ex_pos += b
-            continue
-
-        if x[-1] == "*":
-            vol, note = boost, x[:-1]
-        else:
-            vol, note = 1.0, x
-
-        if not note[-1].isdigit():
-            note += "4"  # default to fourth octave
-
-        a = pitchhz[note] * np.exp2(transpose)
-        kn = keynum[note]
-
-        if y < 0:
-            b = length(-2.0 * y / 3.0)
-        else:
-            b = length(y)
-
-        render2(a, b, vol, int(ex_pos), kn, note)
-        ex_pos += b
-
-    ##########################################################################
-    # Write to output file (in WAV format)
-    ##########################################################################
-
-    data /= data.max() * 2.0
-    out_len = int(2.0 * rate + ex_pos + 0.5)
-    data2 = np.zeros(out_len, np.short)
-    data2[:] = 32767.0 * data[:out_len]
-    f.writeframes(data2.tobytes())
-    if closing:
-        f.close()
+        falloff = (4.0 / lf * endamp) ** (1.0 / cycles)
+
+        # Every sample only feeds back from at least li - 1 samples ago,
+        # so the delay line can be run a whole block of that size at once.
+        step = max(li - 1, 1)
+        for t in range(hi, snd_len, step):
+            t2 = min(t + step, snd_len)
+            v1 = ifac * kps2[t - hi : t2 - hi] + (1.0 - ifac) * kps2[t - li : t2 - li]
+            v2 = (
+                ifac2 * kps2[t - hi + 1 : t2 - hi + 1]
+                + (1.0 - ifac2) * kps2[t - li + 1 : t2 - li + 1]
+            )
+            kps2[t:t2] += 0.5 * (v1 + v2) * falloff
+        mix.add(pos, kps2 * vol * volfac)
+
+    tl = timeline(song, bpm, rate, transpose, pause, boost, repeat)
+    mix = OverlapAdd(10 * rate, block, dtype)
+
+    def play(notes, stop):
+        mix.rewind()
+        for kn, a, vol, pos, _, period, cycles, q, _ in notes.tolist():
+            if kn == rest:
+                continue
+
+            yield from mix.blocks(int(pos))
+            render2(a, period, cycles, q, vol, int(pos))
+
+        yield from mix.finish(stop)
+
+    stop = int(2.0 * rate + song_end(tl) + 0.5)
+    if phrase:
+        bounds, ids = phrases(tl, phrase)
+        yield from assemble(play, tl, bounds, ids, stop, block, dtype)
+    else:
+        yield from repeat_passes(play, tl, repeat, stop, block, dtype)
+
+
+def render(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    gain: str = "peak",
+    phrase: int = 0,
+    dtype=np.float64,
+):
+    """Render a song to an array of samples, scaled as make_wav() writes them.
+
+    Returns the samples and the sample rate, without encoding anything.
+    """
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        gain=gain,
+        phrase=phrase,
+        dtype=dtype,
+    )
+    return np.concatenate(list(blocks)), rate
+
+
+def make_wav(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 44100,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.0,
+    repeat: int = 0,
+    fn: str | BytesIO = "out.wav",
+    closing: bool = True,
+    gain: str = "peak",
+    phrase: int = 0,
+    dtype=np.float64,
+):
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        gain=gain,
+        phrase=phrase,
+        dtype=dtype,
+    )
+    write_wav(fn, blocks, rate, closing)
 
 
 ##########################################################################
@@ -30,22 +30,28 @@
 
 import os
 import shutil
-import struct
 import tarfile
-import wave
 from io import BytesIO
 from typing import Iterable
 
 import numpy as np
 
-__all__ = ("make_wav",)
+from .dsp import Scratch, decay_env
+from .samplebank import SampleBank, bank_files
+
+__all__ = ("make_wav", "render", "render_blocks")
 
 # path to Salamander piano samples (http://freepats.zenvoid.org/Piano/acoustic-grand-piano.html),
 #       48 kHz version:
 
 patchpath = os.path.join(os.path.dirname(__file__), "48khz24bit/")
 
-if not os.path.exists(patchpath):
+# or a pre-decoded bank of the same samples, see samplebank.build_bank()
+bankpath = os.path.dirname(__file__)
+
+if not os.path.exists(patchpath) and not any(
+    os.path.exists(bank_files(bankpath, layer)[0]) for layer in range(1, 17)
+):
 
     if __name__ != "__main__":
         raise FileNotFoundError(
@@ -73,16 +79,24 @@ if not os.path.exists(patchpath):
         shutil.rmtree(folder_name)
 
 
-from .mkfreq import getfn, getfreq
+from .mkfreq import getfreq
+from .score import phrases, rest, song_end, timeline
+from .stream import (
+    OverlapAdd,
+    assemble,
+    gain_stage,
+    headroom,
+    repeat_passes,
+    write_wav,
+)
 
 pitchhz, keynum = getfreq()
 
-# get filenames for sample layer 10:
-fnames = getfn(10)
+# Samples of all velocity layers, loaded on first use
+samples = SampleBank(patchpath, bankpath)
 
-# Preload all samples
-
-notes_cache: dict[str, np.ndarray] = {}
+# Fade-out over the last samples of every sample
+fade_out = np.arange(1, -0.001, -0.001)
 
 
 ##########################################################################
@@ -105,9 +119,152 @@ notes_cache: dict[str, np.ndarray] = {}
 # Output file name
 # fn = 'pysynth_output.wav'
 
+# MIDI velocity (1-127) of a note at normal volume; the velocity of each
+# note in the score scales it to pick the velocity layer of the sample
+# (accents only add ``boost`` gain, they do not switch layers)
+# e.g. velocity = 80
+
+# Gain staging: "peak" normalizes the finished song, "headroom" and
+# "limit" scale each block as it is rendered (see stream.gain_stage)
+# e.g. gain = "limit"
+
+# Largest amplitude of a single note, for the "headroom" estimate
+note_peak = 1.0
+
 ##########################################################################
 
 
+def render_blocks(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 48000,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.1,
+    repeat: int = 0,
+    velocity: int = 80,
+    block: int = 1 << 16,
+    gain: str | None = None,
+    phrase: int = 0,
+    dtype=np.float64,
+):
+    """Render a song as consecutive blocks of raw (unnormalized) samples.
+
+    Notes are mixed in a ring buffer and every block is handed out as soon
+    as no later note can reach into it, so memory does not grow with the
+    length of the song (but see below for repeats). The blocks add up to
+    the full output of make_wav().
+    Notes are shaped and mixed in ``dtype``.
+    With ``gain``, the blocks come scaled for output by that gain mode
+    instead (see stream.gain_stage). With ``phrase``, runs of that many
+    notes that come back later are rendered once (see score.phrases()).
+    Repeated passes and phrases are rendered whole and kept until they last
+    come back, so with ``repeat`` a whole pass of the song is held in memory.
+    """
+    if gain is not None:
+        level = 1.0
+        if gain != "peak":
+            level = headroom(song, bpm, rate, repeat, boost * note_peak)
+        blocks = render_blocks(
+            song,
+            bpm,
+            rate,
+            transpose,
+            leg_stac,
+            pause,
+            boost,
+            repeat,
+            velocity,
+            block=block,
+            phrase=phrase,
+            dtype=dtype,
+        )
+        yield from gain_stage(blocks, gain, level)
+        return
+
+    fade = fade_out.astype(dtype, copy=False)
+
+    work = Scratch(dtype)
+
+    def render2(b, vol, pos, knum, note_velocity):
+        layer = samples.layer(velocity * note_velocity)
+        sample = samples.pitched(knum, 12.0 * transpose, layer)
+        raw_note = len(sample)
+        snd_len = min(int(b), raw_note)
+
+        # Shape the part of the sample that is played in a scratch buffer,
+        # the stored sample and the envelopes are shared read-only arrays.
+        out = work.take(snd_len)
+        out[:] = sample[:snd_len]
+        if samples.scale != 1.0:
+            out *= samples.scale
+
+        dec_ind = min(int(leg_stac * b), snd_len)
+        out[dec_ind:] *= decay_env(snd_len - dec_ind, 3000.0, dtype)
+        fade_ind = raw_note - len(fade)
+        if snd_len > max(fade_ind, 0):
+            out[max(fade_ind, 0) :] *= fade[max(-fade_ind, 0) : snd_len - fade_ind]
+        out *= vol
+        mix.add(pos, out)
+
+    tl = timeline(song, bpm, rate, transpose, pause, boost, repeat)
+    mix = OverlapAdd(10 * rate, block, dtype)
+
+    def play(notes, stop):
+        mix.rewind()
+        for kn, _, vol, pos, b, _, _, _, vel in notes.tolist():
+            if kn == rest:
+                continue
+
+            yield from mix.blocks(int(pos))
+            render2(b, vol, int(pos), kn, vel)
+
+        yield from mix.finish(stop)
+
+    stop = int(2.0 * rate + song_end(tl) + 0.5)
+    if phrase:
+        bounds, ids = phrases(tl, phrase)
+        yield from assemble(play, tl, bounds, ids, stop, block, dtype)
+    else:
+        yield from repeat_passes(play, tl, repeat, stop, block, dtype)
+
+
+def render(
+    song: Iterable[tuple[str, float]],
+    bpm: float = 120.0,
+    rate: int = 48000,
+    transpose: float = 0.0,
+    leg_stac: float = 0.9,
+    pause: float = 0.05,
+    boost: float = 1.1,
+    repeat: int = 0,
+    velocity: int = 80,
+    gain: str = "peak",
+    phrase: int = 0,
+    dtype=np.float64,
+):
+    """Render a song to an array of samples, scaled as make_wav() writes them.
+
+    Returns the samples and the sample rate, without encoding anything.
+    """
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        velocity,
+        gain=gain,
+        phrase=phrase,
+        dtype=dtype,
+    )
+    return np.concatenate(list(blocks)), rate
+
+
 def make_wav(
     song: Iterable[tuple[str, float]],
     bpm: float = 120.0,
@@ -119,98 +276,26 @@ def make_wav(
     repeat: int = 0,
     fn: str | BytesIO = "out.wav",
     closing: bool = True,
+    velocity: int = 80,
+    gain: str = "peak",
+    phrase: int = 0,
+    dtype=np.float64,
 ):
-    f = wave.open(fn, "w")
-    f.setnchannels(1)
-    f.setsampwidth(2)
-    f.setframerate(rate)
-    f.setcomptype("NONE", "Not Compressed")
-
-    bpmfac = 120.0 / bpm
-
-    def length(l: float):
-        return 2 * rate / l * bpmfac
-
-    def getval(v: bytes):
-        a = struct.unpack("i", v + b"\x00")[0] / 256 - 32768
-        if a > 0:
-            a = 1 - a / 32768
-        else:
-            a = -1 - a / 32768
-        return a
-
-    def render2(a, b, vol, pos, knum, note):
-        snd_len = int(b)
-        if note not in notes_cache:
-            with wave.open(patchpath + fnames[knum][0], "rb") as wf:
-                wl = wf.getnframes()
-                wd = wf.readframes(wl)
-                notes_cache[note] = np.array(
-                    [getval(wd[6 * x : 6 * x + 3]) for x in range(wl // 6)]
-                )
-
-        new = notes_cache[note].copy()
-        f = fnames[knum][1]
-        if f > 1:
-            f2 = int(len(new) / f)
-            new2 = np.zeros(f2)
-            for x in range(f2):
-                q = x * f - int(x * f)
-                new2[x] = (1 - q) * new[int(x * f)] + q * new[int(x * f) + 1]
-        else:
-            new2 = new
-        raw_note = len(new2)
-
-        dec_ind = int(leg_stac * b)
-        new2[dec_ind:] *= np.exp(-np.arange(raw_note - dec_ind) / 3000.0)
-        new2[-1001:] *= np.arange(1, -0.001, -0.001)
-        if snd_len > raw_note:
-            snd_len = raw_note
-        data[pos : pos + snd_len] += new2[:snd_len] * vol
-
-    ex_pos = 0.0
-    t_len = 0
-    for y, x in song:
-        if x < 0:
-            t_len += length(-2.0 * x / 3.0)
-        else:
-            t_len += length(x)
-    data = np.zeros(int((repeat + 1) * t_len + 10 * rate))
-
-    for x, y in np.tile(song, (repeat + 1, 1)):  # type: ignore
-        y = float(y)
-
-        if x == "r":
-            b = length(y)
-            ex_pos += b
-            continue
-
-        if x[-1] == "*":
-            vol, note = boost, x[:-1]
-        else:
-            vol, note = 1.0, x
-
-        if not note[-1].isdigit():
-            note += "4"
-
-        a = pitchhz[note] * np.exp2(transpose)
-        kn = keynum[note]
-
-        if y < 0:
-            b = length(-2.0 * y / 3.0)
-        else:
-            b = length(y)
-
-        render2(a, b, vol, int(ex_pos), kn, note)
-        ex_pos += b
-
-    data /= data.max() * 2.0
-    out_len = int(2.0 * rate + ex_pos + 0.5)
-    data2 = np.zeros(out_len, np.short)
-    data2[:] = 32767.0 * data[:out_len]
-    f.writeframes(data2.tobytes())
-    if closing:
-        f.close()
+    blocks = render_blocks(
+        song,
+        bpm,
+        rate,
+        transpose,
+        leg_stac,
+        pause,
+        boost,
+        repeat,
+        velocity,
+        gain=gain,
+        phrase=phrase,
+        dtype=dtype,
+    )
+    write_wav(fn, blocks, rate, closing)
 
 
 ##########################################################################
@@ -0,0 +1,282 @@
+##########################################################################
+# Decoding and pre-decoded banks of the Salamander piano samples
+# used by pysynth_samp
+##########################################################################
+
+import json
+import os
+import sys
+import tarfile
+import wave
+from collections import OrderedDict
+
+import numpy as np
+
+from .dsp import resample
+from .mkfreq import getfn
+
+__all__ = (
+    "decode24",
+    "read_wav",
+    "bank_files",
+    "build_bank",
+    "MappedBank",
+    "SampleBank",
+)
+
+# Format version of the banks written by build_bank()
+bank_version = 1
+
+
+def decode24(wd: bytes, count: int | None = None, framesize: int = 6):
+    """Decode the first channel of 24-bit little-endian PCM frames.
+
+    ``wd`` is the raw frame data as returned by ``wave.readframes()`` and
+    ``framesize`` the number of bytes per frame (6 for 24-bit stereo).
+    Every frame is read as one 32-bit word through a strided view of the
+    buffer, masked to its low 24 bits and scaled in one vectorized pass,
+    with the same arithmetic (and results) as the old per-frame decoder.
+    """
+    count = len(wd) // framesize if count is None else min(count, len(wd) // framesize)
+    if framesize < 4:
+        wd = bytes(wd) + b"\x00"
+
+    words = np.ndarray((count,), "<u4", wd, 0, (framesize,))
+    a = (words & 0xFFFFFF) / 256 - 32768
+    return np.where(a > 0, 1 - a / 32768, -1 - a / 32768)
+
+
+def read_wav(wf: wave.Wave_read):
+    """Decoded sample from an open Salamander WAV file, as the sampler uses it.
+
+    Only the first sixth of the frames is kept, as the sampler always did
+    (it took the frame count for a byte count); this is deliberate, as
+    the samples are long enough and the sound depends on it. Only those
+    frames are read from the file.
+    """
+    wl = wf.getnframes() // 6
+    return decode24(wf.readframes(wl), wl)
+
+
+def bank_files(dest: str, layer: int):
+    """Paths of the sample blob and its index for a velocity layer."""
+    base = os.path.join(dest, "salamander_v%u" % layer)
+    return base + ".npy", base + ".json"
+
+
+def build_bank(
+    source: str, layer: int = 10, dest: str | None = None, dtype=np.float32
+):
+    """Decode one velocity layer of the Salamander samples into a bank.
+
+    ``source`` is the ``48khz24bit`` sample directory or the original
+    ``.tar.xz`` archive; both are read locally. All samples of the layer
+    go back to back into one ``.npy`` blob, with a JSON index of
+    (offset, length) per file name and the format version. float32 keeps the decoded 24-bit
+    values exactly, int16 halves the size at 16-bit resolution.
+    Returns the paths of the blob and the index.
+    """
+    names = sorted({fname for fname, _ in getfn(layer).values()})
+    samples = {}
+
+    if os.path.isdir(source):
+        for name in names:
+            with wave.open(os.path.join(source, name), "rb") as wf:
+                samples[name] = read_wav(wf)
+    else:
+        # walk the archive in order, random access into .tar.xz is slow
+        with tarfile.open(source) as tar:
+            for member in tar:
+                name = os.path.basename(member.name)
+                if name in names and member.isfile():
+                    with wave.open(tar.extractfile(member), "rb") as wf:  # type: ignore
+                        samples[name] = read_wav(wf)
+
+    missing = set(names) - set(samples)
+    if missing:
+        raise FileNotFoundError("Samples not found: %s" % ", ".join(sorted(missing)))
+
+    data = np.concatenate([samples[name] for name in names])
+    scale = 1.0
+    if np.dtype(dtype).kind == "i":
+        scale = 1.0 / np.iinfo(dtype).max
+        data = np.rint(data / scale)
+
+    offsets = np.cumsum([0] + [len(samples[name]) for name in names])
+    index = {
+        "version": bank_version,
+        "layer": layer,
+        "scale": scale,
+        "samples": {
+            name: [int(offsets[n]), len(samples[name])] for n, name in enumerate(names)
+        },
+    }
+
+    dest = dest or os.path.dirname(__file__)
+    os.makedirs(dest, exist_ok=True)
+    npy, idx = bank_files(dest, layer)
+    np.save(npy, data.astype(dtype))
+    with open(idx, "w") as f:
+        json.dump(index, f)
+
+    return npy, idx
+
+
+class MappedBank:
+    """Sample bank written by build_bank(), memory-mapped read-only.
+
+    Opening a bank only reads its index; sample pages are loaded by the OS
+    when first touched and shared between all processes using the bank.
+    """
+
+    def __init__(self, dest: str, layer: int = 10):
+        npy, idx = bank_files(dest, layer)
+        with open(idx) as f:
+            index = json.load(f)
+        if index.get("version") != bank_version:
+            raise ValueError(
+                "Unsupported sample bank version %r in %s, rebuild it"
+                % (index.get("version"), idx)
+            )
+
+        self.layer = index["layer"]
+        self.scale = index["scale"]
+        self.index = index["samples"]
+        self.data = np.load(npy, mmap_mode="r")
+
+    def __contains__(self, name: str):
+        return name in self.index
+
+    def records(self, name: str) -> np.ndarray:
+        """Sample as stored in the bank, a read-only view of the mapping."""
+        offset, length = self.index[name]
+        return self.data[offset : offset + length]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        sample = self.records(name)
+        return sample if self.scale == 1.0 else sample * self.scale
+
+
+class SampleBank:
+    """Salamander samples of all velocity layers, loaded lazily within a budget.
+
+    A sample file is loaded when one of its keys is first played: from the
+    layer's pre-decoded bank in ``bankpath`` if there is one, otherwise
+    decoded from the WAV files in ``patchpath``. Samples are handed out as
+    ``dtype`` (float32 or int16). A bank of that dtype is used in place,
+    so its pages stay shared; decoded or converted samples and those
+    pitched to other keys are kept in memory, and once they take more
+    than ``budget`` bytes, the least recently used ones are dropped again.
+    """
+
+    def __init__(
+        self,
+        patchpath: str,
+        bankpath: str | None = None,
+        budget: int = 64 << 20,
+        dtype=np.float32,
+    ):
+        self.patchpath = patchpath
+        self.bankpath = bankpath
+        self.budget = budget
+        self.dtype = np.dtype(dtype)
+        self.scale = 1.0 / np.iinfo(self.dtype).max if self.dtype.kind == "i" else 1.0
+
+        self.fnames = {layer: getfn(layer) for layer in range(1, 17)}
+        self.banks: dict[int, MappedBank | None] = {}
+        self.cache: OrderedDict = OrderedDict()
+        self.nbytes = 0
+
+        self.layers = [
+            layer
+            for layer in range(1, 17)
+            if os.path.exists(os.path.join(patchpath, self.fnames[layer][0][0]))
+            or (bankpath and os.path.exists(bank_files(bankpath, layer)[0]))
+        ]
+        if not self.layers:
+            raise FileNotFoundError("Piano samples not found in %s" % patchpath)
+
+    def layer(self, velocity: float):
+        """Velocity layer for a MIDI velocity (1-127), or the nearest one present."""
+        want = min(max((int(velocity) + 7) // 8, 1), 16)
+        return min(self.layers, key=lambda layer: abs(layer - want))
+
+    def mapped(self, layer: int):
+        if layer not in self.banks:
+            if self.bankpath and os.path.exists(bank_files(self.bankpath, layer)[0]):
+                self.banks[layer] = MappedBank(self.bankpath, layer)
+            else:
+                self.banks[layer] = None
+
+        return self.banks[layer]
+
+    def fetch(self, key):
+        sample = self.cache.get(key)
+        if sample is not None:
+            self.cache.move_to_end(key)
+
+        return sample
+
+    def store(self, key, sample: np.ndarray):
+        if self.scale != 1.0:
+            sample = np.rint(sample / self.scale)
+        sample = sample.astype(self.dtype)
+        sample.flags.writeable = False
+
+        self.cache[key] = sample
+        self.nbytes += sample.nbytes
+        while self.nbytes > self.budget and len(self.cache) > 1:
+            _, old = self.cache.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+        return sample
+
+    def raw(self, fname: str, layer: int):
+        """Sample file as ``dtype`` records, straight from the bank if it can."""
+        bank = self.mapped(layer)
+        inbank = bank is not None and fname in bank
+        if inbank and bank.data.dtype == self.dtype and bank.scale == self.scale:
+            return bank.records(fname)
+
+        sample = self.fetch(fname)
+        if sample is None:
+            if inbank:
+                sample = self.store(fname, bank[fname])
+            else:
+                with wave.open(os.path.join(self.patchpath, fname), "rb") as wf:
+                    sample = self.store(fname, read_wav(wf))
+
+        return sample
+
+    def pitched(self, knum: int, shift: float, layer: int):
+        """Stored sample for key ``knum`` transposed by ``shift`` semitones.
+
+        Only every third key is sampled; the keys in between (and
+        transposed keys) are resampled from the nearest sample below.
+        Sampled keys come out as the sample file itself (see raw()).
+        """
+        sample = self.fetch((knum, shift, layer))
+        if sample is None:
+            kn = min(max(knum + round(shift), 0), 87)
+            fname, fac = self.fnames[layer][kn]
+            fac *= np.exp2((shift - (kn - knum)) / 12.0)
+            sample = self.raw(fname, layer)
+            if fac == 1.0:
+                return sample
+
+            if self.scale != 1.0:
+                sample = sample * self.scale
+            sample = self.store((knum, shift, layer), resample(sample, fac))
+
+        return sample
+
+
+if __name__ == "__main__":
+    # Usage: samplebank.py SOURCE [LAYER] [DEST] [--int16]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    dtype = np.int16 if "--int16" in sys.argv else np.float32
+    layer = int(args[1]) if len(args) > 1 else 10
+    dest = args[2] if len(args) > 2 else None
+
+    for path in build_bank(args[0], layer, dest, dtype):
+        print("Wrote", path)
@@ -0,0 +1,282 @@
+##########################################################################
+# Compiled scores: songs parsed once into a structured array
+##########################################################################
+
+import json
+from collections import Counter
+
+import numpy as np
+
+from .mkfreq import getfreq
+
+__all__ = (
+    "score_dtype",
+    "timeline_dtype",
+    "rest",
+    "keyfreq",
+    "compile_score",
+    "events",
+    "timeline",
+    "song_end",
+    "rebase",
+    "phrases",
+    "library_files",
+    "save_library",
+    "ScoreLibrary",
+)
+
+pitchhz, keynum = getfreq()
+
+# Frequency of every piano key, as in pitchhz
+keyfreq = np.zeros(88)
+keyfreq[list(keynum.values())] = list(pitchhz.values())
+
+# Key number of a rest
+rest = -1
+
+# One record per note or rest:
+#   key       piano key number (0 = a0, 87 = c8), or ``rest``
+#   onset     start in quarter notes from the beginning of the song
+#   value     note value, 1 = whole note, 4 = quarter (dotted notes resolved)
+#   velocity  volume factor, 1.0 = normal
+#   accent    asterisk note, played louder by ``boost``
+score_dtype = np.dtype(
+    [
+        ("key", np.int16),
+        ("onset", np.float64),
+        ("value", np.float64),
+        ("velocity", np.float32),
+        ("accent", np.bool_),
+    ]
+)
+
+# Format version of the score libraries written by save_library()
+library_version = 1
+
+# One record per note or rest as played, in samples:
+#   key       as in the score
+#   freq      frequency after transposing (0 for rests)
+#   volume    velocity, times ``boost`` for accents
+#   onset     start, fractional (engines start notes at int(onset))
+#   length    time to the next onset, fractional
+#   period    samples per cycle of the note (0 for rests)
+#   cycles    whole cycles that fill the length less the pause
+#   size      samples of those cycles, or the whole length of a rest
+#   velocity  as in the score, without the accent
+timeline_dtype = np.dtype(
+    [
+        ("key", np.int16),
+        ("freq", np.float64),
+        ("volume", np.float64),
+        ("onset", np.float64),
+        ("length", np.float64),
+        ("period", np.float64),
+        ("cycles", np.float64),
+        ("size", np.int64),
+        ("velocity", np.float32),
+    ]
+)
+
+
+def compile_score(song) -> np.ndarray:
+    """Parse a song of ``(note, value)`` pairs into a score array.
+
+    Notes without an octave default to the fourth, negative values are
+    dotted (-4 = dotted quarter). A score that is already compiled is
+    returned as it is, so every engine accepts either form.
+    """
+    if isinstance(song, np.ndarray) and song.dtype == score_dtype:
+        return song
+
+    song = [(str(x), float(y)) for x, y in song]
+    score = np.zeros(len(song), score_dtype)
+
+    values = np.array([y for _, y in song])
+    score["value"] = np.where(values < 0, -2.0 * values / 3.0, values)
+    beats = 4.0 / score["value"]
+    score["onset"] = np.cumsum(beats) - beats
+    score["velocity"] = 1.0
+
+    for i, (x, _) in enumerate(song):
+        if x == "r":
+            score["key"][i] = rest
+            continue
+        if x[-1] == "*":
+            score["accent"][i], x = True, x[:-1]
+        if not x[-1].isdigit():
+            x += "4"  # default to fourth octave
+        score["key"][i] = keynum[x]
+
+    return score
+
+
+def events(score: np.ndarray, boost: float = 1.0, repeat: int = 0):
+    """(key, value, volume) of every note and rest in playing order.
+
+    Plain Python numbers, with accents boosted and the song repeated
+    ``repeat`` more times, ready for the per-note loops of the engines.
+    """
+    vol = np.where(score["accent"], boost, 1.0) * score["velocity"]
+    keys, values = score["key"].tolist(), score["value"].tolist()
+    return list(zip(keys, values, vol.tolist())) * (repeat + 1)
+
+
+def timeline(
+    song,
+    bpm: float = 120.0,
+    rate: float = 44100,
+    transpose: float = 0.0,
+    pause: float = 0.0,
+    boost: float = 1.0,
+    repeat: int = 0,
+) -> np.ndarray:
+    """Compile a song or score into a timeline, all notes at once.
+
+    Lengths are the note values at ``bpm``, onsets their running sum, both
+    exactly as the engines used to accumulate them note by note. A song
+    played note after note takes ``timeline["size"].sum()`` samples, one
+    with overlapping notes ``int(2.0 * rate + song_end(timeline) + 0.5)``.
+    """
+    score = np.tile(compile_score(song), repeat + 1)
+    notes = score["key"] != rest
+    bpmfac = 120.0 / bpm
+
+    tl = np.zeros(len(score), timeline_dtype)
+    tl["key"] = score["key"]
+    tl["volume"] = np.where(score["accent"], boost, 1.0) * score["velocity"]
+    tl["velocity"] = score["velocity"]
+    tl["length"] = 2 * rate / score["value"] * bpmfac
+    tl["onset"][1:] = np.cumsum(tl["length"])[:-1]
+
+    freq = keyfreq[score["key"][notes]] * np.exp2(transpose)
+    period = rate / freq
+    cycles = np.round((1.0 - pause) * tl["length"][notes] / rate * freq)
+    tl["freq"][notes] = freq
+    tl["period"][notes] = period
+    tl["cycles"][notes] = cycles
+    tl["size"][notes] = (period * cycles).astype(np.int64)
+    tl["size"][~notes] = tl["length"][~notes].astype(np.int64)
+    return tl
+
+
+def song_end(tl: np.ndarray) -> float:
+    """Sample position where the last note or rest of a timeline ends."""
+    return float(tl["onset"][-1] + tl["length"][-1]) if len(tl) else 0.0
+
+
+def rebase(tl: np.ndarray) -> np.ndarray:
+    """The same notes, with onsets counted from the first one.
+
+    Onsets are summed up again from the lengths, so the same notes always
+    come out at the same (fractional) positions, wherever they were.
+    """
+    tl = tl.copy()
+    tl["onset"][1:] = np.cumsum(tl["length"])[:-1]
+    tl["onset"][:1] = 0.0
+    return tl
+
+
+def phrases(tl: np.ndarray, width: int = 8):
+    """Split a timeline into phrases, numbering the same phrases the same.
+
+    Every run of ``width`` notes and rests is hashed by its content (all
+    but the onsets). Runs that occur more than once become phrases of
+    their own; the notes in between are kept together as plain phrases.
+    Returns the bounds of the phrases (rows ``bounds[k]:bounds[k + 1]``)
+    and the number of each phrase's content.
+    """
+    if width < 1:
+        raise ValueError("phrase width must be at least 1, not %r" % width)
+    body = tl.copy()
+    body["onset"] = 0.0
+    raw, size, n = body.tobytes(), tl.dtype.itemsize, len(tl)
+
+    def content(i: int, j: int):
+        return raw[i * size : j * size]
+
+    counts = Counter(content(i, i + width) for i in range(n - width + 1))
+
+    def repeated(i: int):
+        return i + width <= n and counts[content(i, i + width)] > 1
+
+    bounds, keys, i = [0], [], 0
+    while i < n:
+        j = i + width
+        if not repeated(i):
+            j = i + 1
+            while j < n and not repeated(j):
+                j += 1
+        keys.append(content(i, j))
+        bounds.append(j)
+        i = j
+
+    numbers = {key: k for k, key in enumerate(dict.fromkeys(keys))}
+    return np.array(bounds), np.array([numbers[key] for key in keys], int)
+
+
+def library_files(base: str):
+    """Paths of the record blob and its index for a score library."""
+    return base + ".npy", base + ".json"
+
+
+def save_library(base: str, songs: dict):
+    """Compile songs into a score library on disk.
+
+    ``songs`` maps names to songs or scores. The records of all scores go
+    back to back into one ``.npy`` file of ``score_dtype``, with a JSON
+    index of (offset, length) per name and the format version.
+    Returns the paths of the blob and the index.
+    """
+    scores = {name: compile_score(song) for name, song in songs.items()}
+    offsets = np.cumsum([0] + [len(score) for score in scores.values()])
+    index = {
+        "version": library_version,
+        "scores": {
+            name: [int(offsets[n]), len(score)]
+            for n, (name, score) in enumerate(scores.items())
+        },
+    }
+
+    npy, idx = library_files(base)
+    np.save(npy, np.concatenate([np.zeros(0, score_dtype), *scores.values()]))
+    with open(idx, "w") as f:
+        json.dump(index, f)
+
+    return npy, idx
+
+
+class ScoreLibrary:
+    """Score library written by save_library(), memory-mapped read-only.
+
+    Opening a library only reads its index; records are loaded by the OS
+    when first touched and shared between all processes using the library.
+    Scores come out as read-only views that every engine accepts directly.
+    """
+
+    def __init__(self, base: str):
+        npy, idx = library_files(base)
+        with open(idx) as f:
+            index = json.load(f)
+        if index.get("version") != library_version:
+            raise ValueError(
+                "Unsupported score library version %r in %s"
+                % (index.get("version"), idx)
+            )
+
+        self.index = index["scores"]
+        self.data = np.load(npy, mmap_mode="r")
+        if self.data.dtype != score_dtype:
+            raise ValueError("Records in %s are not scores" % npy)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __contains__(self, name: str):
+        return name in self.index
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        offset, length = self.index[name]
+        return self.data[offset : offset + length]
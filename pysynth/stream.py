@@ -0,0 +1,339 @@
+##########################################################################
+# Block-wise overlap-add of notes for streaming renders
+##########################################################################
+
+import wave
+from io import BytesIO
+
+import numpy as np
+
+from .dsp import onepole
+from .score import rest, timeline
+
+__all__ = (
+    "OverlapAdd",
+    "Limiter",
+    "headroom",
+    "gain_stage",
+    "pcm16",
+    "write_wav",
+    "replay",
+    "assemble",
+    "variants",
+    "passes",
+    "repeat_passes",
+)
+
+# Output level that the gain modes aim for, as in data /= data.max() * 2.0
+ceiling = 0.5
+
+
+class OverlapAdd:
+    """Ring buffer that mixes notes and hands out finished blocks of samples.
+
+    Notes must be added in order of onset: everything before the onset of
+    the latest note is final, so it is handed out in blocks of ``block``
+    samples and its space reused. The buffer only has to span the longest
+    note (``tail`` samples) plus one block, whatever the length of the song;
+    it grows by itself if a longer note comes along.
+    """
+
+    def __init__(self, tail: int, block: int = 1 << 16, dtype=float):
+        self.block = block
+        self.buf = np.zeros(int(tail) + block, dtype)
+        self.pos = 0  # first sample not handed out yet
+        self.end = 0  # end of the last sample mixed in
+
+    def spans(self, start: int, length: int):
+        """Slices of the ring holding ``length`` samples from ``start`` on."""
+        i = start % len(self.buf)
+        first = min(length, len(self.buf) - i)
+        return slice(i, i + first), slice(0, length - first), first
+
+    def add(self, pos: int, x: np.ndarray):
+        """Mix ``x`` into the output from sample ``pos`` on."""
+        if pos < self.pos:
+            raise ValueError("notes must be added in order of onset")
+        if pos + len(x) > self.pos + len(self.buf):
+            self.resize(pos + len(x) - self.pos + self.block)
+
+        a, b, first = self.spans(pos, len(x))
+        self.buf[a] += x[:first]
+        self.buf[b] += x[first:]
+        self.end = max(self.end, pos + len(x))
+
+    def take(self, length: int):
+        a, b, _ = self.spans(self.pos, length)
+        out = np.concatenate([self.buf[a], self.buf[b]])
+        self.buf[a] = 0.0
+        self.buf[b] = 0.0
+        self.pos += length
+        return out
+
+    def resize(self, size: int):
+        pending = self.take(len(self.buf))
+        self.pos -= len(pending)
+        self.buf = np.zeros(size, self.buf.dtype)
+        self.add(self.pos, pending)
+
+    def blocks(self, upto: int):
+        """Hand out all complete blocks that end before sample ``upto``."""
+        while self.pos + self.block <= upto:
+            yield self.take(self.block)
+
+    def finish(self, stop: int | None = None):
+        """Hand out the rest of the output up to sample ``stop``.
+
+        Whatever was mixed beyond ``stop`` is dropped, and samples that no
+        note reaches come out as silence. Without ``stop``, the output
+        ends with the last sample mixed in.
+        """
+        if stop is None:
+            stop = max(self.end, self.pos)
+        while self.pos < stop:
+            yield self.take(min(self.block, stop - self.pos))
+
+        self.buf[:] = 0.0
+        self.pos = stop
+
+    def rewind(self):
+        """Start over at sample 0, once everything has been handed out."""
+        self.pos = self.end = 0
+
+
+def replay(blocks, repeat: int = 0):
+    """Hand out the blocks, then all of them again ``repeat`` more times.
+
+    Blocks are only kept for replaying when there is a repeat, but then
+    all of them are, so memory grows with the length of ``blocks``.
+    """
+    kept = []
+    for block in blocks:
+        if repeat:
+            kept.append(block)
+        yield block
+
+    for _ in range(repeat):
+        yield from kept
+
+
+def assemble(play, tl, bounds, ids, stop: int, block: int = 1 << 16, dtype=float):
+    """Blocks of a timeline put together from renders of its phrases.
+
+    Rows ``bounds[k]:bounds[k + 1]`` of the timeline are phrase k, and
+    phrases with the same id play the same notes (see score.phrases()).
+    ``play(notes, stop)`` mixes the notes of a timeline into blocks up to
+    sample ``stop``, or on to the end of the last note for None. Each
+    phrase is played once, kept whole for as long as it comes up again, and
+    overlap-added at every onset where it does, so the tails of notes
+    ring on across the seams. Phrases are played with their onsets counted
+    from the whole sample where they start, so every note lands on the
+    same sample as in a render of the whole timeline.
+    """
+    ids = variants(tl, bounds, ids)
+    last = {n: k for k, n in enumerate(ids.tolist())}
+    renders = {}
+    mix = OverlapAdd(0, block, dtype)
+
+    for k, n in enumerate(ids.tolist()):
+        first, end = bounds[k], bounds[k + 1]
+        start = int(tl["onset"][first])
+        render = renders.pop(n, None)
+        if render is None:
+            notes = tl[first:end].copy()
+            notes["onset"] -= start
+            render = np.concatenate([np.zeros(0, dtype), *play(notes, None)])
+        if last[n] > k:
+            renders[n] = render
+
+        yield from mix.blocks(start)
+        mix.add(start, render)
+
+    yield from mix.finish(stop)
+
+
+def variants(tl, bounds, ids):
+    """Number the phrases of a timeline the same only if they render the same.
+
+    Notes start at ``int(onset)``, so with fractional note lengths the same
+    phrase can start its notes one sample earlier or later, relative to its
+    first whole sample, depending on where it comes up. Phrases with the
+    same id (see assemble()) are told apart by those relative starts.
+    """
+    onsets = tl["onset"].astype(np.int64)
+    keys = [
+        (n, (onsets[first:end] - onsets[first]).tobytes())
+        for n, first, end in zip(ids.tolist(), bounds[:-1], bounds[1:])
+    ]
+    numbers = {key: k for k, key in enumerate(dict.fromkeys(keys))}
+    return np.array([numbers[key] for key in keys], int)
+
+
+def passes(tl, repeat: int = 0):
+    """Bounds and ids of the passes of a timeline repeated ``repeat`` times.
+
+    As for assemble(): every pass is a phrase, and they are all the same.
+    """
+    n = len(tl) // (repeat + 1)
+    if not repeat or not n:
+        return np.array([0, len(tl)]), np.zeros(1, int)
+
+    return np.arange(0, len(tl) + 1, n), np.zeros(repeat + 1, int)
+
+
+def repeat_passes(
+    play, tl, repeat: int, stop: int, block: int = 1 << 16, dtype=float
+):
+    """Blocks of a timeline that plays the same notes ``repeat`` + 1 times.
+
+    Only the first pass is played (see assemble() for ``play``), the
+    others are copies of it.
+    """
+    bounds, ids = passes(tl, repeat)
+    if len(ids) == 1:
+        yield from play(tl, stop)
+        return
+
+    yield from assemble(play, tl, bounds, ids, stop, block, dtype)
+
+
+def window_min(x: np.ndarray, width: int):
+    """Minimum of every ``width`` consecutive samples of ``x``.
+
+    Van Herk / Gil-Werman: prefix and suffix minima within segments of
+    ``width`` samples combine to any window in two vectorized passes.
+    """
+    n = len(x)
+    seg = np.full(-(-n // width) * width, np.inf)
+    seg[:n] = x
+    seg = seg.reshape(-1, width)
+    pre = np.minimum.accumulate(seg, axis=1).ravel()
+    suf = np.minimum.accumulate(seg[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.minimum(suf[: n - width + 1], pre[width - 1 : n])
+
+
+class Limiter:
+    """Look-ahead peak limiter for a stream of blocks.
+
+    Every block is scaled by ``gain``; where that would exceed ``ceiling``
+    the gain is pulled down smoothly over the ``lookahead`` samples before
+    the peak and recovers with a one-pole release of ``release`` samples.
+    The output is never louder than ``ceiling``. It is delayed internally
+    by the look-ahead, but run() hands out exactly as many samples as it
+    was given, aligned with the input.
+    """
+
+    def __init__(
+        self,
+        gain: float = 1.0,
+        ceiling: float = ceiling,
+        lookahead: int = 256,
+        release: float = 4800.0,
+    ):
+        self.gain = gain
+        self.ceiling = ceiling
+        self.width = lookahead
+        self.release = release
+        self.hist = np.zeros(2 * (lookahead - 1))
+        self.state = 1.0
+        self.skip = lookahead - 1
+
+    def process(self, block: np.ndarray):
+        """Limit one block, returns the samples that are complete so far."""
+        w = self.width
+        x = np.concatenate([self.hist, block * self.gain])
+        self.hist = x[len(x) - len(self.hist) :]
+
+        # Gain that keeps each sample below the ceiling, its minimum over
+        # the look-ahead window, then a moving average over the same
+        # window: every average only covers windows that contain the
+        # sample itself, so it never exceeds the gain the sample needs.
+        need = np.minimum(1.0, self.ceiling / np.maximum(np.abs(x), 1e-300))
+        csum = np.append(0.0, np.cumsum(window_min(need, w)))
+        env = np.minimum(1.0, (csum[w:] - csum[:-w]) / w)
+        rel, self.state = onepole(env, self.release, self.state)
+
+        out = x[w - 1 : w - 1 + len(env)] * np.minimum(env, rel)
+        np.clip(out, -self.ceiling, self.ceiling, out=out)  # rounding of the sums
+        out, self.skip = out[self.skip :], max(self.skip - len(out), 0)
+        return out
+
+    def run(self, blocks):
+        for block in blocks:
+            out = self.process(block)
+            if len(out):
+                yield out
+
+        yield self.process(np.zeros(self.width - 1))
+
+
+def headroom(
+    song,
+    bpm: float,
+    rate: float,
+    repeat: int = 0,
+    peak: float = 1.0,
+    window: float = 1.0,
+):
+    """Fixed gain for a song, estimated without rendering it.
+
+    ``peak`` is the largest amplitude of a single note. Polyphony is the
+    largest number of notes starting within ``window`` seconds of each
+    other; overlapping notes are assumed to add up like uncorrelated
+    signals, so the gain allows for the square root of the polyphony.
+    """
+    tl = timeline(song, bpm, rate, repeat=repeat)
+    onsets = tl["onset"][tl["key"] != rest]
+
+    starts = np.arange(len(onsets))
+    poly = np.max(np.searchsorted(onsets, onsets + window * rate) - starts, initial=1)
+    return float(ceiling / (peak * np.sqrt(poly)))
+
+
+def gain_stage(blocks, gain: str = "peak", level: float = 1.0):
+    """Blocks scaled for 16-bit output by one of the gain modes.
+
+    "peak" normalizes the largest sample of the whole song to ``ceiling``
+    and so has to render all of it first. "headroom" scales by the fixed
+    ``level`` (see headroom()), and "limit" does the same through a
+    Limiter; both hand out every block as soon as it is rendered.
+    """
+    if gain == "peak":
+        data = np.concatenate(list(blocks))
+        data /= data.max() / ceiling
+        yield data
+    elif gain == "headroom":
+        for block in blocks:
+            yield block * level
+    elif gain == "limit":
+        yield from Limiter(level).run(blocks)
+    else:
+        raise ValueError("unknown gain mode %r" % gain)
+
+
+def pcm16(block: np.ndarray):
+    """16-bit PCM frames of a block, clipped to full scale."""
+    return np.clip(32767.0 * block, -32768, 32767).astype(np.short).tobytes()
+
+
+def write_wav(
+    fn: str | BytesIO, blocks, rate: float, closing: bool = True, encode=pcm16
+):
+    """Write blocks of samples to a mono 16-bit WAV file as they come.
+
+    ``encode`` turns a block into PCM frames. With ``closing=False`` the
+    file is left open (e.g. to read a BytesIO back), its header complete.
+    """
+    f = wave.open(fn, "w")
+
+    f.setnchannels(1)
+    f.setsampwidth(2)
+    f.setframerate(rate)
+    f.setcomptype("NONE", "Not Compressed")
+
+    for block in blocks:
+        f.writeframesraw(encode(block))
+
+    f.writeframes(b"")
+    if closing:
+        f.close()
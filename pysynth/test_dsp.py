@@ -0,0 +1,139 @@
+from unittest import TestCase
+
+import numpy as np
+
+from pysynth import dsp
+from pysynth.dsp import (
+    NoiseBank,
+    Scratch,
+    decay_env,
+    fade_ramp,
+    fade_tail,
+    onepole,
+    pulse,
+    saw_table,
+    wavetable,
+)
+
+
+def onepole_loop(x, k, sp=0.0):
+    out = []
+    for osc in x:
+        sp += (osc - sp) / k
+        out.append(sp)
+    return np.array(out)
+
+
+class TestOnePole(TestCase):
+    def test_matches_loop(self):
+        x = np.random.default_rng(1).random(20000) * 2 - 1
+        for k in (1, 10, 100):
+            y, state = onepole(x, k)
+            np.testing.assert_allclose(y, onepole_loop(x, k), atol=1e-12)
+            self.assertEqual(state, y[-1])
+
+    def test_state_carries_across_buffers(self):
+        x = np.random.default_rng(2).random(5000)
+        y1, state = onepole(x[:1234], 10)
+        y2, _ = onepole(x[1234:], 10, state)
+        np.testing.assert_allclose(np.concatenate([y1, y2]), onepole_loop(x, 10))
+
+    def test_empty(self):
+        y, state = onepole(np.zeros(0), 100, 0.5)
+        self.assertEqual(len(y), 0)
+        self.assertEqual(state, 0.5)
+
+
+class TestFadeTail(TestCase):
+    def test_linear(self):
+        fade = fade_tail(300)
+        self.assertEqual(fade[200], 1.0)
+        self.assertEqual(fade[201], 0.99)
+        self.assertEqual(fade[-1], 0.01)
+
+    def test_short_note(self):
+        ramp = np.linspace(1, 0, num=50)
+        np.testing.assert_array_equal(fade_tail(50, ramp), ramp[::-1])
+
+    def test_ramp(self):
+        for q in (0, 1, 2, 50, 99, 100, 5000):
+            ref = fade_tail(q, np.linspace(1, 0, num=q))
+            self.assertEqual(len(fade_ramp(q)), min(q, 99))
+            np.testing.assert_array_equal(fade_tail(q, fade_ramp(q)), ref)
+
+
+class TestSawTable(TestCase):
+    def test_shape(self):
+        table = saw_table(0, 44100)
+        ramp = 2.0 * np.arange(len(table) - 1) / (len(table) - 1) - 1.0
+        np.testing.assert_allclose(table[100:-100], ramp[100:-99], atol=0.01)
+        self.assertEqual(table[0], table[-1])
+
+    def test_cached(self):
+        self.assertIs(saw_table(40, 44100), saw_table(40, 44100))
+
+    def test_band_limited(self):
+        # c8 at 44.1 kHz only has room for its fundamental and 4 overtones
+        spec = np.abs(np.fft.rfft(saw_table(87, 44100)[:-1]))
+        self.assertTrue(np.all(spec[6:] < 1e-9))
+
+    def test_lookup(self):
+        table = saw_table(48, 44100)
+        osc = wavetable(table, 0.25, 8)
+        np.testing.assert_allclose(osc[4:], osc[:4])
+
+
+class TestPulse(TestCase):
+    def test_square(self):
+        x = np.arange(10000)
+        square = np.where((x // 50.5) % 2, 1.0, -1.0)
+        np.testing.assert_array_equal(pulse(101.0, 10000), square)
+
+    def test_duty(self):
+        osc = pulse(100.0, 1000, 0.25)
+        self.assertEqual((osc > 0).mean(), 0.25)
+        self.assertEqual(osc[74], -1.0)
+        self.assertEqual(osc[75], 1.0)
+
+    def test_cache_grows(self):
+        short = pulse(37.3, 100).copy()
+        long = pulse(37.3, 5000)
+        np.testing.assert_array_equal(long[:100], short)
+        self.assertFalse(long.flags.writeable)
+
+    def test_cache_budget(self):
+        budget, dsp.signals.budget = dsp.signals.budget, 100000
+        try:
+            for period in np.arange(20.0, 60.0, 0.5):
+                pulse(period, 5000)
+                saw_table(period, 8000)
+                self.assertLessEqual(dsp.signals.nbytes, 100000)
+        finally:
+            dsp.signals.budget = budget
+
+
+class TestNoiseBank(TestCase):
+    def test_seeded(self):
+        a, b = NoiseBank(7, size=100), NoiseBank(7, size=100)
+        for n in (30, 90, 250):
+            np.testing.assert_array_equal(a.take(n), b.take(n))
+
+    def test_slices_are_consecutive(self):
+        bank = NoiseBank(7, size=100)
+        noise = np.concatenate([bank.take(n) for n in (30, 90, 250)])
+        np.testing.assert_array_equal(noise[:100], NoiseBank(7, size=100).block)
+        self.assertEqual(len(noise), 370)
+
+    def test_decay_env(self):
+        ref = np.exp(-np.arange(500) / 1000)
+        np.testing.assert_allclose(decay_env(500, 1000.0), ref)
+
+
+class TestScratch(TestCase):
+    def test_reuse(self):
+        work = Scratch()
+        a = work.take(100)
+        self.assertTrue(np.shares_memory(a, work.take(50)))
+        self.assertFalse(np.shares_memory(a, work.take(50, slot=1)))
+        self.assertEqual(len(work.take(300)), 300)
+        self.assertGreaterEqual(len(work.bufs[0]), 300)
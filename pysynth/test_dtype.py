@@ -0,0 +1,67 @@
+from unittest import TestCase
+
+import numpy as np
+
+from pysynth import (
+    pysynth,
+    pysynth_b,
+    pysynth_c,
+    pysynth_d,
+    pysynth_e,
+    pysynth_p,
+    pysynth_s,
+)
+from pysynth.dsp import NoiseBank, decay_env, onepole, phase, pulse
+from pysynth.testing import wav_frames
+
+song = (("c4", 8), ("e4*", 8), ("a6", 4), ("r", 8), ("g2", -8))
+
+
+def render(engine, **kw):
+    return wav_frames(engine, song, np_seed=4, **kw)
+
+
+class TestFloat32(TestCase):
+    def test_engines(self):
+        engines = {
+            pysynth: {},
+            pysynth_b: {},
+            pysynth_c: {},
+            pysynth_d: {},
+            pysynth_e: {},
+            pysynth_p: {"seed": 2},
+            pysynth_s: {},
+        }
+        for engine, kw in engines.items():
+            ref = render(engine, rate=16000, **kw)
+            out = render(engine, rate=16000, dtype=np.float32, **kw)
+            self.assertEqual(len(out), len(ref))
+            self.assertLessEqual(np.abs(out.astype(int) - ref).max(), 2, engine)
+
+    def test_names(self):
+        for engine in (pysynth, pysynth_b, pysynth_e):
+            ref = render(engine, rate=8000)
+            for dtype in ("float64", np.dtype("d")):
+                out = render(engine, rate=8000, dtype=dtype)
+                np.testing.assert_array_equal(out, ref)
+
+    def test_blocks(self):
+        for engine in (pysynth_b, pysynth_e, pysynth_s):
+            np.random.seed(4)
+            blocks = engine.render_blocks(song, rate=8000, dtype=np.float32)
+            self.assertTrue(all(block.dtype == np.float32 for block in blocks))
+
+    def test_kernels(self):
+        x = np.random.default_rng(0).random(5000).astype(np.float32)
+        self.assertEqual(onepole(x, 100)[0].dtype, np.float32)
+        self.assertEqual(pulse(50.5, 100, dtype=np.float32).dtype, np.float32)
+        self.assertEqual(decay_env(100, 10.0, np.float32).dtype, np.float32)
+        self.assertEqual(NoiseBank(1, 64, np.float32).take(100).dtype, np.float32)
+        np.testing.assert_allclose(
+            NoiseBank(1, 64, np.float32).take(100), NoiseBank(1, 64).take(100), 1e-6
+        )
+
+    def test_phase(self):
+        x = np.arange(500000.0, 500100.0)
+        out = np.sin(phase(x, 7.3, dtype=np.float32))
+        np.testing.assert_allclose(out, np.sin(phase(x, 7.3)), 0, 1e-5)
@@ -0,0 +1,216 @@
+from unittest import TestCase
+
+import numpy as np
+
+from pysynth import dsp, pysynth, pysynth_b, pysynth_beeper, pysynth_e, pysynth_s
+from pysynth.mkfreq import getfreq
+from pysynth.testing import wav_frames
+
+pitchhz, keynum = getfreq()
+
+song = (("c4", 8), ("e4*", 8), ("a5", 16), ("r", 16), ("g3", 4))
+
+# Every 750th frame (of the first 18000) that the original B wrote for
+# ``song`` at 8 kHz, out of 26000
+b_frames = [
+    *(0, -378, 6906, 718, 14315, 4957, 3410, -5486, -1435, -515, -10043, 9561),
+    *(389, -6949, 5504, -1996, -86, 1229, -1749, 1491, 3, -872, 549, -237),
+]
+
+# The same for the original E
+e_frames = [
+    *(0, -1212, 3481, 3102, 10544, 4853, 2533, -3737, -1613, 115, -6169, 6220),
+    *(149, -5303, 3575, -1168, -40, 633, -995, 824, 4, -440, 277, -80),
+]
+
+
+def pysynth_loop(song, rate, pause=0.05, boost=1.0):
+    """PySynth A as it used to be, one sample at a time."""
+    out = []
+    for note, value in song:
+        b = 2 * rate / value
+        if note == "r":
+            out += [0.0] * int(b)
+            continue
+
+        vol = boost if note[-1] == "*" else 1.0
+        a = pitchhz[note.rstrip("*")]
+        period, cycles = rate / a, round((1.0 - pause) * b / rate * a)
+        q = int(period * cycles)
+
+        lf = np.log(a)
+        lf_fac = (lf - 3.0) / pysynth.harm_max
+        harm = 0 if lf_fac > 1 else 2.0 * (1 - lf_fac)
+        decay = 2.0 / lf
+        t = (lf - 3.0) / (8.5 - 3.0)
+        volfac = 1.0 + 0.8 * t * np.cos(np.pi / 5.3 * (lf - 3.0))
+
+        for x in range(q):
+            if x < 100:
+                fac = x / 80.0
+            elif x < 300:
+                fac = 1.25 - (x - 100) / 800.0
+            elif x > q - 400:
+                fac = 1.0 - ((x - q + 400) / 400.0)
+            else:
+                fac = 1.0
+
+            s = x / q
+            dfac = 1.0 - s + s * decay
+            osc = (
+                np.sin(2.0 * np.pi * x / period)
+                + harm * np.sin(2.0 * np.pi * x / (period / 2.0))
+                + 0.5 * harm * np.sin(2.0 * np.pi * x / (period / 4.0))
+            )
+            out.append(osc / 4.0 * fac * vol * dfac * volfac)
+
+    return np.array(out)
+
+
+def karplus_strong_loop(song, rate, pause=0.05, boost=1.0, endamp=0.25, sm=10):
+    """PySynth S as it used to be, with its delay line one sample at a time."""
+    data = np.zeros(int(sum(2 * rate / value for _, value in song) + 20 * rate))
+    pos = 0.0
+    for note, value in song:
+        b = 2 * rate / value
+        if note == "r":
+            pos += b
+            continue
+
+        vol = boost if note[-1] == "*" else 1.0
+        a = pitchhz[note.rstrip("*")]
+        period, cycles = rate / a, round((1.0 - pause) * b / rate * a)
+        q = int(period * cycles)
+
+        lf = np.log(a)
+        t = (lf - 3.0) / (8.5 - 3.0)
+        volfac = 1.0 + 0.8 * t * np.cos(np.pi / 5.3 * (lf - 3.0))
+        snd_len = int((10.0 - lf) * q)
+        if lf < 4:
+            snd_len *= 2
+
+        kp_len = int(period)
+        kps1 = np.zeros(snd_len)
+        kps2 = np.zeros(snd_len)
+        kps1[:kp_len] = np.random.normal(size=kp_len)
+        for t in range(kp_len):
+            kps2[t] = kps1[t : t + sm].mean()
+
+        li, hi = int(np.floor(period)), int(np.ceil(period))
+        ifac = period % 1
+        ifac2 = (period * (np.floor(period) - 1) / np.floor(period)) % 1
+        falloff = (4.0 / lf * endamp) ** (1.0 / cycles)
+        for t in range(hi, snd_len):
+            v1 = ifac * kps2[t - hi] + (1.0 - ifac) * kps2[t - li]
+            v2 = ifac2 * kps2[t - hi + 1] + (1.0 - ifac2) * kps2[t - li + 1]
+            kps2[t] += 0.5 * (v1 + v2) * falloff
+
+        data[int(pos) : int(pos) + snd_len] += kps2 * vol * volfac
+        pos += b
+
+    data /= data.max() * 2.0
+    return data[: int(2.0 * rate + pos + 0.5)]
+
+
+def beeper_loop(song, rate, boost=1.0):
+    """The beeper as it used to be, one sample at a time."""
+    out = []
+    for note, value in song:
+        duration = int(2 * rate / value)
+        if note == "r":
+            out += [0] * duration
+            continue
+
+        vol = boost if note[-1] == "*" else 1.0
+        freq = 27.5 * 2.0 ** (keynum[note.rstrip("*")] / 12.0)
+        period = int(rate / 4 / freq)
+
+        cycle = []
+        for x in range(period):
+            pos = x / period
+            level1 = (np.sin(2.0 * np.pi * pos) + np.sin(2.0 * np.pi * pos * 2)) / 2
+            level2 = 0
+            for start, finish, start_level, finish_level in pysynth_beeper.waveform:
+                if start <= pos <= finish:
+                    localpos = (pos - start) / (finish - start)
+                    level2 = (finish_level - start_level) * localpos + start_level
+                    break
+            cycle.append((level1 + level2) / 2 * vol)
+
+        for x in range(duration):
+            level = cycle[x % period]
+            if x < 100 or duration - x < 100:
+                level *= min(x, duration - x) / 100.0
+            out.append(round(32767 * level))
+
+    return np.array(out)
+
+
+class TestPySynthA(TestCase):
+    def test_reference(self):
+        ref = pysynth_loop(song, 8000, boost=1.2)
+        data, _ = pysynth.render(song, rate=8000, boost=1.2)
+        self.assertEqual(len(data), len(ref))
+        np.testing.assert_allclose(data, ref, rtol=0, atol=1e-12)
+
+
+class TestPySynthS(TestCase):
+    def test_reference(self):
+        np.random.seed(3)
+        ref = karplus_strong_loop(song, 8000, boost=1.2)
+        np.random.seed(3)
+        data, _ = pysynth_s.render(song, rate=8000, boost=1.2)
+        self.assertEqual(len(data), len(ref))
+        np.testing.assert_allclose(data, ref, rtol=0, atol=1e-12)
+
+
+class TestBeeper(TestCase):
+    def test_reference(self):
+        ref = beeper_loop(song, 8000, boost=0.8)
+        out = wav_frames(pysynth_beeper, song, rate=8000, boost=0.8)
+        np.testing.assert_array_equal(out, ref)
+
+    def test_cache_budget(self):
+        # every boost is a waveform of its own, all under the budget of signals
+        budget, dsp.signals.budget = dsp.signals.budget, 1000
+        try:
+            for boost in np.linspace(0.5, 1.5, 20):
+                pysynth_beeper.render(song, rate=8000, boost=boost)
+                self.assertLessEqual(dsp.signals.nbytes, 1000)
+                self.assertIn("beep", [key[0] for key in dsp.signals.entries])
+        finally:
+            dsp.signals.budget = budget
+
+
+class TestPySynthB(TestCase):
+    def test_baseline(self):
+        out = wav_frames(pysynth_b, song, rate=8000, quality=-np.inf)
+        self.assertEqual(len(out), 26000)
+        self.assertEqual(out[:18000:750].tolist(), b_frames)
+
+    def test_quality(self):
+        high = (("c6", 8), ("e6*", 8), ("g6", 8), ("c7", 4), ("a6", 8), ("c4", 4))
+        ref = wav_frames(pysynth_b, high, rate=16000, quality=-np.inf)
+        out = wav_frames(pysynth_b, high, rate=16000)
+        self.assertEqual(len(out), len(ref))
+        self.assertLessEqual(np.abs(out.astype(int) - ref).max(), 16)
+        self.assertFalse(np.array_equal(out, ref))
+
+        # the top octave keeps only its second harmonic, like the keys below
+        for note in ("a6", "c7", "c8"):
+            partials = pysynth_b.partial_lists[pysynth_b.quality][keynum[note]]
+            self.assertEqual(partials, [(2.0, 2)])
+
+
+class TestPySynthE(TestCase):
+    def test_baseline(self):
+        out = wav_frames(pysynth_e, song, rate=8000)
+        self.assertEqual(len(out), 26000)
+        self.assertEqual(out[:18000:750].tolist(), e_frames)
+
+    def test_blocks(self):
+        riff = song[:3] * 4 + (("c4", 4), ("a5", 16))
+        ref = np.concatenate(list(pysynth_e.render_blocks(riff, rate=8000)))
+        # notes are synthesized when they come up, and dropped after their last use
+        blocks = pysynth_e.render_blocks(riff, rate=8000, block=64)
+        np.testing.assert_array_equal(np.concatenate(list(blocks)), ref)
@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from nokiacomposer2wav import parse_ringtone as p
+from pysynth.nokiacomposer2wav import parse_ringtone as p
 
 
 class TestParseRingtone(TestCase):
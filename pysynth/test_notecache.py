@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+import numpy as np
+
+from pysynth import notecache, pysynth_b, pysynth_e
+from pysynth.notecache import NoteCache
+from pysynth.testing import wav_frames
+
+song = (("c4", 8), ("e4*", 8), ("c4", 4), ("r", 8), ("g3", -8))
+
+
+class TestNoteCache(TestCase):
+    def test_lru(self):
+        cache = NoteCache(budget=3 * 800)
+        for n in range(4):
+            cache.put(n, np.zeros(100))
+        self.assertNotIn(0, cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 2400)
+
+        cache.get(1)
+        cache.put(4, np.zeros(100))
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.misses, 1)
+
+    def test_replace(self):
+        cache = NoteCache()
+        cache.put("a", np.zeros(100))
+        cache.put("a", np.zeros(300))
+        self.assertEqual(cache.nbytes, 2400)
+
+    def test_read_only(self):
+        wave = NoteCache().put("a", np.zeros(10))
+        with self.assertRaises(ValueError):
+            wave[0] = 1.0
+
+
+class TestShared(TestCase):
+    def tearDown(self):
+        notecache.disable()
+
+    def test_engines(self):
+        for engine in (pysynth_b, pysynth_e):
+            ref = wav_frames(engine, song, rate=8000)
+            shared = notecache.enable()
+            np.testing.assert_array_equal(wav_frames(engine, song, rate=8000), ref)
+            misses = shared.misses
+            self.assertGreater(len(shared), 0)
+
+            np.testing.assert_array_equal(wav_frames(engine, song, rate=8000), ref)
+            self.assertEqual(shared.misses, misses)
+            self.assertGreater(shared.hits, 0)
+
+            out = wav_frames(engine, song, rate=8000, transpose=1)
+            self.assertFalse(np.array_equal(out, ref))
+            self.assertGreater(shared.misses, misses)
+            notecache.disable()
@@ -0,0 +1,189 @@
+import json
+import os
+import struct
+import tarfile
+import tempfile
+import wave
+from unittest import TestCase, mock
+
+import numpy as np
+
+from pysynth.mkfreq import getfn
+from pysynth.dsp import resample
+from pysynth.samplebank import (
+    MappedBank,
+    SampleBank,
+    build_bank,
+    decode24,
+    read_wav,
+)
+from pysynth.score import compile_score
+
+
+def getval(v):
+    a = struct.unpack("<i", v + b"\x00")[0] / 256 - 32768
+    if a > 0:
+        a = 1 - a / 32768
+    else:
+        a = -1 - a / 32768
+    return a
+
+
+class TestDecode24(TestCase):
+    def test_matches_struct(self):
+        wd = np.random.default_rng(0).integers(0, 256, 6000, np.uint8).tobytes()
+        wd += bytes((0, 0, 0x80, 1, 2, 3, 255, 255, 255, 0, 0, 0, 0, 0, 0, 9, 9, 9))
+        ref = [getval(wd[6 * x : 6 * x + 3]) for x in range(len(wd) // 6)]
+        np.testing.assert_array_equal(decode24(wd), ref)
+
+    def test_count(self):
+        wd = bytes(range(60))
+        self.assertEqual(len(decode24(wd, 4)), 4)
+        self.assertEqual(len(decode24(wd, 100)), 10)
+        self.assertEqual(len(decode24(b"")), 0)
+
+    def test_mono(self):
+        wd = bytes(range(30))
+        ref = [getval(wd[3 * x : 3 * x + 3]) for x in range(10)]
+        np.testing.assert_array_equal(decode24(wd, framesize=3), ref)
+
+
+class TestBank(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, "48khz24bit")
+        os.mkdir(self.src)
+        rng = np.random.default_rng(3)
+        names = {fname for layer in (5, 10) for fname, _ in getfn(layer).values()}
+        for name in names:
+            with wave.open(os.path.join(self.src, name), "wb") as wf:
+                wf.setnchannels(2)
+                wf.setsampwidth(3)
+                wf.setframerate(48000)
+                wf.writeframes(rng.integers(0, 256, 6 * 600, np.uint8).tobytes())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check(self, bank, atol=0.0):
+        self.assertEqual(len(bank.index), 30)
+        for name in bank.index:
+            with wave.open(os.path.join(self.src, name), "rb") as wf:
+                np.testing.assert_allclose(bank[name], read_wav(wf), atol=atol)
+
+    def test_directory(self):
+        build_bank(self.src, 10, self.tmp.name)
+        bank = MappedBank(self.tmp.name, 10)
+        self.assertIsInstance(bank.data, np.memmap)
+        self.check(bank)
+
+    def test_tarball(self):
+        tar_file = os.path.join(self.tmp.name, "samples.tar.xz")
+        with tarfile.open(tar_file, "w:xz") as tar:
+            tar.add(self.src, "Salamander/48khz24bit")
+        build_bank(tar_file, 10, self.tmp.name)
+        self.check(MappedBank(self.tmp.name, 10))
+
+    def test_version(self):
+        _, idx = build_bank(self.src, 10, self.tmp.name)
+        with open(idx) as f:
+            index = json.load(f)
+        del index["version"]
+        with open(idx, "w") as f:
+            json.dump(index, f)
+        with self.assertRaises(ValueError):
+            MappedBank(self.tmp.name, 10)
+
+    def test_int16(self):
+        build_bank(self.src, 10, self.tmp.name, np.int16)
+        bank = MappedBank(self.tmp.name, 10)
+        self.assertEqual(bank.data.dtype, np.int16)
+        self.check(bank, atol=1.0 / 32767)
+
+
+class TestSampleBank(TestCase):
+    setUp = TestBank.setUp
+    tearDown = TestBank.tearDown
+
+    def test_layers(self):
+        samples = SampleBank(self.src)
+        self.assertEqual(samples.layers, [5, 10])
+        self.assertEqual(samples.layer(80), 10)
+        self.assertEqual(samples.layer(127), 10)
+        self.assertEqual(samples.layer(30), 5)
+
+    def test_pitched(self):
+        samples = SampleBank(self.src, dtype=np.float64)
+        fname, fac = getfn(10)[40]
+        with wave.open(os.path.join(self.src, fname), "rb") as wf:
+            ref = resample(read_wav(wf), fac)
+        np.testing.assert_array_equal(samples.pitched(40, 0.0, 10), ref)
+
+    def test_int16(self):
+        samples = SampleBank(self.src, dtype=np.int16)
+        for knum in (39, 40):
+            np.testing.assert_allclose(
+                samples.pitched(knum, 0.0, 10) * samples.scale,
+                SampleBank(self.src).pitched(knum, 0.0, 10),
+                atol=1.0 / 32767,
+            )
+
+    def test_budget(self):
+        samples = SampleBank(self.src, budget=2000)
+        for knum in range(0, 88, 5):
+            samples.pitched(knum, 0.0, samples.layer(30))
+            self.assertLessEqual(samples.nbytes, 2000)
+        self.assertIn((85, 0.0, 5), samples.cache)
+        self.assertNotIn((0, 0.0, 5), samples.cache)
+
+    def test_mapped(self):
+        build_bank(self.src, 10, self.tmp.name)
+        samples = SampleBank(os.path.join(self.tmp.name, "missing"), self.tmp.name)
+        self.assertEqual(samples.layers, [10])
+        for knum in (6, 7):
+            np.testing.assert_array_equal(
+                samples.pitched(knum, 0.0, 10),
+                SampleBank(self.src).pitched(knum, 0.0, 10),
+            )
+
+    def test_shared(self):
+        build_bank(self.src, 10, self.tmp.name)
+        samples = SampleBank(self.src, self.tmp.name)
+        bank = samples.mapped(10)
+        knum = next(k for k, (_, fac) in getfn(10).items() if fac == 1.0)
+
+        sample = samples.pitched(knum, 0.0, 10)
+        self.assertTrue(np.shares_memory(sample, bank.data))
+        self.assertFalse(sample.flags.writeable)
+        self.assertEqual(samples.nbytes, 0)
+
+        other = samples.pitched(knum + 1, 0.0, 10)
+        self.assertFalse(np.shares_memory(other, bank.data))
+        self.assertGreater(samples.nbytes, 0)
+
+    def test_velocity(self):
+        try:
+            from pysynth import pysynth_samp
+        except FileNotFoundError:
+            self.skipTest("piano samples not installed")
+
+        score = compile_score((("c4", 8), ("c4", 8)))
+        score["velocity"][1] = 0.4
+        samples = SampleBank(self.src)
+        with mock.patch.object(pysynth_samp, "samples", samples):
+            pysynth_samp.render(score, rate=8000, gain="headroom")
+        for layer in (5, 10):
+            self.assertIn(getfn(layer)[39][0], samples.cache)
+
+    def test_accent(self):
+        try:
+            from pysynth import pysynth_samp
+        except FileNotFoundError:
+            self.skipTest("piano samples not installed")
+
+        # an accent scales the gain but keeps the layer of the note's velocity
+        samples = SampleBank(self.src)
+        with mock.patch.object(pysynth_samp, "samples", samples):
+            pysynth_samp.render((("c4*", 8),), rate=8000, boost=0.4, gain="headroom")
+        self.assertIn(getfn(10)[39][0], samples.cache)
+        self.assertNotIn(getfn(5)[39][0], samples.cache)
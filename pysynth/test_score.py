@@ -0,0 +1,133 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from pysynth import pysynth, pysynth_b, pysynth_c, pysynth_e, pysynth_p, pysynth_s
+from pysynth.score import (
+    ScoreLibrary,
+    compile_score,
+    events,
+    keyfreq,
+    library_files,
+    phrases,
+    rebase,
+    rest,
+    save_library,
+    score_dtype,
+    song_end,
+    timeline,
+)
+
+song = (("c4", 8), ("e*", 8), ("bb3", 4), ("r", 8), ("g3", -8))
+
+
+class TestScore(TestCase):
+    def test_compile(self):
+        score = compile_score(song)
+        self.assertEqual(score.dtype, score_dtype)
+        self.assertEqual(score["key"].tolist(), [39, 43, 37, rest, 34])
+        self.assertEqual(score["accent"].tolist(), [False, True, False, False, False])
+        np.testing.assert_allclose(score["value"], [8, 8, 4, 8, 16 / 3])
+        np.testing.assert_allclose(score["onset"], [0, 0.5, 1, 2, 2.5])
+        self.assertEqual(keyfreq[48], 440.0)
+        self.assertIs(compile_score(score), score)
+
+    def test_events(self):
+        score = compile_score(song)
+        score["velocity"][0] = 0.5
+        ev = events(score, boost=2.0, repeat=1)
+        self.assertEqual(len(ev), 10)
+        self.assertEqual(ev[:2], [(39, 8.0, 0.5), (43, 8.0, 2.0)])
+        self.assertEqual(ev[5:], ev[:5])
+
+    def test_engines(self):
+        score = compile_score(song)
+        engines = (pysynth, pysynth_b, pysynth_c, pysynth_e, pysynth_p, pysynth_s)
+        for engine in engines:
+            kw = {"seed": 1} if engine is pysynth_p else {}
+            np.random.seed(1)
+            ref, _ = engine.render(song, rate=8000, repeat=1, **kw)
+            np.random.seed(1)
+            out, _ = engine.render(score, rate=8000, repeat=1, **kw)
+            np.testing.assert_array_equal(out, ref)
+
+
+class TestTimeline(TestCase):
+    def test_onsets(self):
+        tl = timeline(song, 95, 22050, repeat=2)
+        pos = 0.0
+        for (_, value), onset in zip(list(song) * 3, tl["onset"]):
+            self.assertEqual(onset, pos)
+            value = value if value > 0 else -2.0 * value / 3.0
+            pos += 2 * 22050 / value * (120.0 / 95)
+        self.assertEqual(song_end(tl), pos)
+        self.assertEqual(song_end(timeline((), 95, 22050)), 0.0)
+
+    def test_sizes(self):
+        tl = timeline(song, 130, 8000, 1.0, pause=0.1)
+        data, _ = pysynth.render(song, 130, 8000, 1.0, pause=0.1)
+        self.assertEqual(len(data), tl["size"].sum())
+        self.assertEqual(tl["freq"][2], keyfreq[37] * 2)
+        self.assertTrue((tl["size"] <= tl["length"]).all())
+
+        tl = timeline(song, 130, 8000)
+        data, _ = pysynth_s.render(song, 130, 8000)
+        self.assertEqual(len(data), int(2.0 * 8000 + song_end(tl) + 0.5))
+
+    def test_phrases(self):
+        riff = (("c4", 8), ("e4", 8), ("g4", 4))
+        tl = timeline(riff * 2 + song + riff, 95, 8000)
+        bounds, ids = phrases(tl, 3)
+        self.assertEqual(bounds.tolist(), [0, 3, 6, 11, 14])
+        self.assertEqual(ids.tolist(), [0, 0, 1, 0])
+
+        part = rebase(tl[6:11])
+        self.assertEqual(part["onset"][0], 0.0)
+        np.testing.assert_array_equal(part["onset"], timeline(song, 95, 8000)["onset"])
+        self.assertEqual(tl["onset"][6], timeline(riff * 2, 95, 8000)["length"].sum())
+
+        bounds, ids = phrases(tl[:5], 8)
+        self.assertEqual((bounds.tolist(), ids.tolist()), ([0, 5], [0]))
+
+        for width in (0, -1):
+            with self.assertRaises(ValueError):
+                phrases(tl, width)
+
+
+class TestLibrary(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.tmp.name, "songs")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        songs = {"one": song, "empty": (), "two": compile_score(song[:2])}
+        save_library(self.base, songs)
+        lib = ScoreLibrary(self.base)
+
+        self.assertEqual(list(lib), ["one", "empty", "two"])
+        self.assertNotIn("three", lib)
+        for name, ref in songs.items():
+            np.testing.assert_array_equal(lib[name], compile_score(ref))
+        self.assertIsInstance(lib.data, np.memmap)
+        self.assertFalse(lib["one"].flags.writeable)
+
+        ref, _ = pysynth.render(song, rate=8000)
+        out, _ = pysynth.render(lib["one"], rate=8000)
+        np.testing.assert_array_equal(out, ref)
+
+    def test_version(self):
+        _, idx = save_library(self.base, {"one": song})
+        with open(idx) as f:
+            index = json.load(f)
+        index["version"] += 1
+        with open(idx, "w") as f:
+            json.dump(index, f)
+        with self.assertRaises(ValueError):
+            ScoreLibrary(self.base)
+        self.assertEqual(library_files(self.base)[1], idx)
@@ -0,0 +1,177 @@
+from unittest import TestCase
+
+import numpy as np
+
+from pysynth import pysynth, pysynth_b, pysynth_beeper, pysynth_e, pysynth_p, pysynth_s
+from pysynth.score import rest, song_end, timeline
+from pysynth.stream import (
+    Limiter,
+    OverlapAdd,
+    gain_stage,
+    headroom,
+    pcm16,
+    repeat_passes,
+    replay,
+    window_min,
+)
+from pysynth.testing import wav_frames
+
+
+class TestOverlapAdd(TestCase):
+    def mix(self, tail, block):
+        rng = np.random.default_rng(5)
+        onsets = np.sort(rng.integers(0, 5000, 40))
+        notes = [rng.random(rng.integers(1, 700)) for _ in onsets]
+
+        ref = np.zeros(6000)
+        for pos, x in zip(onsets, notes):
+            ref[pos : pos + len(x)] += x
+
+        mix = OverlapAdd(tail, block)
+        out = []
+        for pos, x in zip(onsets, notes):
+            blocks = list(mix.blocks(pos))
+            self.assertTrue(all(len(b) == block for b in blocks))
+            out += blocks
+            mix.add(pos, x)
+        out += mix.finish(5500)
+        return ref[:5500], np.concatenate(out), mix
+
+    def test_matches_array(self):
+        for block in (1, 64, 1000, 10000):
+            ref, out, _ = self.mix(700, block)
+            np.testing.assert_array_equal(out, ref)
+
+    def test_grows(self):
+        ref, out, mix = self.mix(10, 128)
+        np.testing.assert_array_equal(out, ref)
+        self.assertLessEqual(len(mix.buf), 700 + 2 * 128)
+
+    def test_order(self):
+        mix = OverlapAdd(100, 10)
+        list(mix.blocks(50))
+        with self.assertRaises(ValueError):
+            mix.add(20, np.ones(5))
+
+    def test_finish_at_end(self):
+        mix = OverlapAdd(100, 64)
+        mix.add(30, np.ones(90))
+        self.assertEqual(len(np.concatenate(list(mix.finish()))), 120)
+
+
+class TestGain(TestCase):
+    def test_window_min(self):
+        x = np.random.default_rng(2).random(1000)
+        for w in (1, 7, 64, 1000):
+            ref = [x[i : i + w].min() for i in range(len(x) - w + 1)]
+            np.testing.assert_array_equal(window_min(x, w), ref)
+
+    def test_limiter(self):
+        x = np.sin(np.arange(20000) / 20.0) * np.linspace(0, 3, 20000)
+        out = np.concatenate(list(Limiter(1.0).run(np.array_split(x, 7))))
+        self.assertEqual(len(out), len(x))
+        self.assertLessEqual(np.abs(out).max(), 0.5)
+        np.testing.assert_allclose(out[:3000], x[:3000])
+        self.assertGreater(np.abs(out[-1000:]).max(), 0.45)
+
+    def test_headroom(self):
+        song = [("c", 4), ("e", 4), ("r", 4), ("g", 4)]
+        self.assertEqual(headroom(song, 120, 1000, peak=2.0), 0.5 / 2.0 / np.sqrt(2))
+        self.assertEqual(headroom(song, 60, 1000, peak=2.0), 0.5 / 2.0)
+
+    def test_modes(self):
+        blocks = [np.ones(10), -np.ones(10) * 3]
+        np.testing.assert_array_equal(
+            next(gain_stage(iter(blocks))), [0.5] * 10 + [-1.5] * 10
+        )
+        self.assertEqual(len(list(gain_stage(iter(blocks), "headroom", 0.1))), 2)
+        with self.assertRaises(ValueError):
+            list(gain_stage(iter(blocks), "loud"))
+
+
+class TestRenderBlocks(TestCase):
+    song = (("c4", 8), ("e4*", 8), ("c4", 4), ("r", 8), ("g3", -8))
+
+    def test_block_size(self):
+        for engine in (pysynth_b, pysynth_e, pysynth_s):
+            np.random.seed(1)
+            full = np.concatenate(list(engine.render_blocks(self.song, rate=8000)))
+            np.random.seed(1)
+            blocks = list(engine.render_blocks(self.song, rate=8000, block=1000))
+            self.assertEqual(len(blocks), -(-len(full) // 1000))
+            np.testing.assert_array_equal(np.concatenate(blocks), full)
+            self.assertEqual(len(full), int(2.0 * 8000 + 1.625 * 8000 + 0.5))
+
+
+class TestRender(TestCase):
+    song = (("c4", 8), ("e4*", 8), ("c4", 4), ("r", 8), ("g3", -8))
+
+    def test_matches_make_wav(self):
+        engines = {
+            pysynth: {},
+            pysynth_b: {"gain": "headroom"},
+            pysynth_e: {},
+            pysynth_p: {"seed": 1},
+            pysynth_s: {"gain": "limit"},
+        }
+        for engine, kw in engines.items():
+            np.random.seed(1)
+            data, rate = engine.render(self.song, rate=8000, **kw)
+            self.assertEqual(rate, 8000)
+
+            out = wav_frames(engine, self.song, np_seed=1, rate=8000, **kw)
+            self.assertEqual(out.tobytes(), pcm16(data))
+
+    def test_beeper(self):
+        data, rate = pysynth_beeper.render(self.song, rate=8000)
+        self.assertEqual(len(data), 2000 + 2000 + 4000 + 2000 + 3000)
+        self.assertLessEqual(np.abs(data).max(), 1.0)
+
+
+class TestRepeat(TestCase):
+    song = (("c4", 8), ("e4*", 8), ("c4", 4), ("r", 8), ("g3", -8))
+
+    def test_replay(self):
+        self.assertEqual(list(replay(iter([1, 2]), 2)), [1, 2, 1, 2, 1, 2])
+        self.assertEqual(list(replay(iter([1, 2]))), [1, 2])
+
+    def test_passes(self):
+        # every note rings on for longer than the rest at the end of the song
+        tl = timeline(self.song, 120, 1000, repeat=2)
+
+        def play(notes, stop):
+            mix = OverlapAdd(700, 64)
+            for pos in notes["onset"][notes["key"] != rest].astype(int).tolist():
+                yield from mix.blocks(pos)
+                mix.add(pos, np.linspace(1, 0, 700))
+            yield from mix.finish(stop)
+
+        stop = int(2.0 * 1000 + song_end(tl) + 0.5)
+        ref = np.concatenate(list(play(tl, stop)))
+        out = np.concatenate(list(repeat_passes(play, tl, 2, stop, 64)))
+        np.testing.assert_allclose(out, ref, atol=1e-12)
+
+    def test_sequential(self):
+        once, _ = pysynth.render(self.song, rate=8000)
+        out, _ = pysynth.render(self.song, rate=8000, repeat=2)
+        np.testing.assert_array_equal(out, np.tile(once, 3))
+
+    def test_phrases(self):
+        riff = (("c4", 8), ("e4", 8), ("g4", 8), ("c5", 8)) * 3 + (("a4", 4),)
+        song = riff * 3 + (("d4", 2),)
+        for engine in (pysynth_b, pysynth_e):
+            ref, _ = engine.render(song, rate=8000, gain="headroom")
+            out, _ = engine.render(song, rate=8000, gain="headroom", phrase=4)
+            np.testing.assert_allclose(out, ref, atol=1e-12)
+
+    def test_fractional(self):
+        # at 130 bpm, note lengths and the onsets of later passes are
+        # fractional, and every note must still land on its own sample
+        riff = (("c4", 8), ("e4", 8), ("g4", 8), ("c5", 8)) * 3 + (("a4", 4),)
+        for engine in (pysynth_b, pysynth_e):
+            ref = np.concatenate(list(engine.render_blocks(riff * 2, 130, 8000)))
+            for kw in ({"repeat": 1}, {"phrase": 4}):
+                song = riff * 2 if "phrase" in kw else riff
+                blocks = engine.render_blocks(song, 130, 8000, **kw)
+                out = np.concatenate(list(blocks))
+                np.testing.assert_allclose(out, ref, atol=1e-12)
@@ -0,0 +1,25 @@
+##########################################################################
+# Helpers shared by the test modules
+##########################################################################
+
+import wave
+from io import BytesIO
+
+import numpy as np
+
+__all__ = ("wav_frames",)
+
+
+def wav_frames(engine, song, np_seed: int | None = None, **kw) -> np.ndarray:
+    """16-bit frames that ``engine.make_wav()`` writes for a song.
+
+    The file is written to memory and read back. With ``np_seed``, NumPy's
+    global random state is seeded first, for the engines that draw noise.
+    """
+    out = BytesIO()
+    if np_seed is not None:
+        np.random.seed(np_seed)
+    engine.make_wav(song, fn=out, closing=False, **kw)
+    out.seek(0)
+    with wave.open(out) as wf:
+        return np.frombuffer(wf.readframes(wf.getnframes()), np.int16)